@@ -1,9 +1,84 @@
+import json
+from argparse import ArgumentParser
+from pathlib import Path
+
 from arkhe.debugger import ADB
 
 
-def main():
-    adb = ADB()
-    adb.run()
+def compile_(args):
+    from arkhe.aot import translate
+    from arkhe.lang.compiler import Parser
+
+    parser = Parser(optimize=args.optimize)
+    code = parser(args.source.read_text())
+    if args.optimize:
+        print(f"Optimizer saved {parser.saved} code words")
+    output = args.output or args.source.with_name(f"{args.source.stem}_ark.py")
+    output.write_text(translate(code, source=args.source.name))
+
+
+def run_(args):
+    from arkhe import binary
+    from arkhe.lang.compiler import Parser
+    from arkhe.parallel import run
+
+    parser = Parser()
+    programs = [
+        binary.loads(path.read_bytes()) if path.suffix == ".arkc" else parser(path.read_text())
+        for path in args.programs
+    ]
+    states = json.loads(args.states.read_text()) if args.states else None
+    results = run(
+        programs,
+        states,
+        workers=args.workers,
+        chunksize=args.chunksize,
+        instructions=args.instructions,
+        seconds=args.seconds,
+    )
+    for job, result in enumerate(results):
+        error = result.error
+        line = {
+            "job": job,
+            "counter": result.counter,
+            "registers": result.registers,
+            "symtable": list(result.symtable.items()),
+            "error": None if error is None else f"{type(error).__name__}: {error}",
+        }
+        print(json.dumps(line, default=repr))
+
+
+def main(argv=None):
+    parser = ArgumentParser(prog="arkhe")
+    commands = parser.add_subparsers(dest="command")
+
+    compiler = commands.add_parser("compile", help="compile assembly to a Python module")
+    compiler.add_argument("source", type=Path)
+    compiler.add_argument("-o", "--output", type=Path)
+    compiler.add_argument(
+        "-O", "--optimize", action="store_true", help="run the peephole optimizer"
+    )
+    compiler.set_defaults(func=compile_)
+
+    runner = commands.add_parser(
+        "run", help="run programs (.ark or .arkc) on a process pool"
+    )
+    runner.add_argument("programs", type=Path, nargs="+")
+    runner.add_argument(
+        "--states", type=Path, help="JSON list of initial registers, one job each"
+    )
+    runner.add_argument("-j", "--workers", type=int)
+    runner.add_argument("--chunksize", type=int)
+    runner.add_argument("--instructions", type=int, help="instruction budget per job")
+    runner.add_argument("--seconds", type=float, help="time budget per job")
+    runner.set_defaults(func=run_)
+
+    args = parser.parse_args(argv)
+    if args.command is None:
+        adb = ADB()
+        adb.run()
+    else:
+        args.func(args)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,268 @@
+"""
+Ahead-of-time compiler from Arkhe bytecode to a Python module.
+
+The program is split into basic blocks and every block becomes a function
+that runs its instructions and returns the next block function. Targets that
+are known statically (fallthroughs, not taken branches, jumps whose register
+was loaded earlier in the same block) are returned directly; everything else
+goes through the `BLOCKS` dispatch table. A target that isn't a block start
+(e.g a jump into operands) is handed to the state's own interpreter until it
+reaches one, so the state must be an `Arkhe` (compatible) instance holding
+the same code.
+"""
+from arkhe.controller import Arkhe
+from arkhe.jit import COMPARISONS, CONDITIONAL_JUMPS, MATH
+from arkhe.vm import ArkheException, Operation, load_const
+
+REGISTERS = 32
+JUMPS = frozenset({Operation.JMP, Operation.JMPF, Operation.JMPB, *CONDITIONAL_JUMPS})
+ENDS_BLOCK = JUMPS | {Operation.HLT}
+
+HEADER = '''\
+"""Generated by arkhe.aot from {source}, do not edit."""
+from arkhe.vm import HLT, Instr, MemoryFault, Operation, Switch, UnknownSymbol
+
+CODE = {code!r}
+SIZE = len(CODE)
+'''
+
+RUNTIME = '''
+def goto(vm, target):
+    block = BLOCKS.get(target)
+    if block is None:
+        vm.counter = target
+        if target >= SIZE:
+            return None
+        return interpret
+    return block
+
+
+def interpret(vm, regs):
+    while vm.counter < SIZE:
+        vm.exc_instr()
+        if vm.counter in BLOCKS:
+            return BLOCKS[vm.counter]
+
+
+def run(vm):
+    regs = vm.registers.data
+    block = goto(vm, vm.counter)
+    try:
+        while block is not None and not vm.threads:  # threads start in interpret
+            block = block(vm, regs)
+    except Switch:
+        vm.schedule()
+    if vm.threads:
+        vm.eval()  # green threads take turns on the VM
+'''
+
+
+def constants(instructions):
+    """Maps registers to the set of int constants ever LOADed into them"""
+    consts = {}
+    for _, instr, _ in instructions:
+        if instr.operation is Operation.LOAD:
+            value = const_of(instr)
+            if isinstance(value, int):
+                consts.setdefault(instr.operands[0], set()).add(value)
+    return consts
+
+
+def const_of(instr):
+    instr.op = 0
+    try:
+        instr.get_8()
+        return load_const(instr)
+    except (ArkheException, IndexError):
+        return None
+
+
+def leaders(instructions):
+    boundaries = {offset for offset, _, _ in instructions}
+    consts = constants(instructions)
+    result = {0}
+    for offset, instr, end in instructions:
+        if instr.operation not in ENDS_BLOCK:
+            continue
+        result.add(end)
+        if not instr.operands:
+            continue
+
+        candidates = consts.get(instr.operands[0], ())
+        if instr.operation in (Operation.JMPF, Operation.JFE, Operation.JFN):
+            result.update(end + value for value in candidates)
+        elif instr.operation is Operation.JMPB:
+            result.update(end - value for value in candidates)
+        elif instr.operation is not Operation.HLT:
+            result.update(candidates)
+    return sorted(result & boundaries)
+
+
+class Block:
+    def __init__(self, start, size):
+        self.start = start
+        self.size = size
+        self.lines = []
+        self.known = {}
+
+    def emit(self, *lines):
+        self.lines.extend(lines)
+
+    def goto(self, target, leaders):
+        if isinstance(target, int):
+            if target >= self.size:
+                return [f"vm.counter = {target}", "return None"]
+            if target in leaders:
+                return [f"return block_{target}"]
+        return [f"return goto(vm, {target})"]
+
+    def register(self, register):
+        if not 0 <= register < REGISTERS:
+            raise IndexError(register)
+        return register
+
+    def write(self, register):
+        self.known.pop(register, None)
+        return self.register(register)
+
+    def translate(self, instr, end, leaders):
+        """Returns False if the block continues after instr"""
+        operation, operands = instr.operation, instr.operands
+        self.emit(f"pc = {end}")
+        if operation is Operation.LOAD:
+            value = const_of(instr)
+            if value is None:
+                raise IndexError(operands)
+            target = self.write(operands[0])
+            if isinstance(value, int):
+                self.known[target] = value
+            self.emit(f"regs[{target}] = {value!r}")
+        elif operation in MATH:
+            operand1, operand2 = map(self.register, operands[:2])
+            target = self.write(operands[2])
+            self.emit(f"regs[{target}] = regs[{operand1}] {MATH[operation]} regs[{operand2}]")
+        elif operation in COMPARISONS:
+            operand1, operand2 = map(self.register, operands[:2])
+            self.emit(f"vm._eqflag = regs[{operand1}] {COMPARISONS[operation]} regs[{operand2}]")
+        elif operation in JUMPS:
+            register = self.register(operands[0])
+            value = self.known.get(register)
+            if operation is Operation.JMPB:
+                target = f"{end} - t" if value is None else end - value
+            elif operation in (Operation.JMPF, Operation.JFE, Operation.JFN):
+                target = f"{end} + t" if value is None else end + value
+            else:
+                target = "t" if value is None else value
+
+            self.emit(f"t = regs[{register}]")
+            if operation in CONDITIONAL_JUMPS:
+                _, on_flag = CONDITIONAL_JUMPS[operation]
+                condition = "vm._eqflag" if on_flag else "not vm._eqflag"
+                self.emit(f"if {condition}:")
+                self.emit(*(f"    {line}" for line in self.goto(target, leaders)))
+                self.emit(*self.goto(end, leaders))
+            else:
+                self.emit(*self.goto(target, leaders))
+            return True
+        elif operation is Operation.READ:
+            position = self.register(operands[0])
+            target = self.write(operands[1])
+            self.emit(
+                "try:",
+                f"    regs[{target}] = vm.memory[regs[{position}]]",
+                "except IndexError:",
+                '    raise MemoryFault("Read operation to not owned area!")',
+            )
+        elif operation is Operation.INSERT:
+            position, value = map(self.register, operands[:2])
+            self.emit(
+                f"p, v = regs[{position}], regs[{value}]",
+                "try:",
+                "    vm.memory[p] = v",
+                "except IndexError:",
+                '    raise MemoryFault("Insert operation to not owned area!")',
+            )
+        elif operation is Operation.SYMSET:
+            name, value = map(self.register, operands[:2])
+            self.emit(f"vm.symtable[regs[{name}]] = regs[{value}]")
+        elif operation is Operation.SYMREAD:
+            name = self.register(operands[0])
+            target = self.write(operands[1])
+            self.emit(
+                f"key = regs[{name}]",
+                "try:",
+                f"    regs[{target}] = vm.symtable[key]",
+                "except KeyError:",
+                '    raise UnknownSymbol(f"{key}")',
+            )
+        elif operation is Operation.NOP:
+            pass
+        elif operation is Operation.HLT:
+            self.emit("raise HLT()")
+            return True
+        else:
+            raise IndexError(operation)
+        return False
+
+    def generic(self, instr, end, leaders):
+        """Runs instr through the VM's handler"""
+        self.known.clear()
+        self.emit(
+            f"vm.counter = {end}",
+            f"vm.machine.dispatch(Instr(Operation.{instr.operation.name}, {list(map(int, instr.operands))}))",
+        )
+        if instr.operation in ENDS_BLOCK:
+            self.emit(*self.goto("vm.counter", leaders))
+            return True
+        return False
+
+    def source(self, follow, leaders):
+        lines = self.lines
+        if follow is not None:
+            lines = lines + self.goto(follow, leaders)
+        return "\n".join(
+            [
+                f"def block_{self.start}(vm, regs):",
+                f"    pc = {self.start}",
+                "    try:",
+                *(f"        {line}" for line in lines),
+                "    except BaseException:",
+                "        vm.counter = pc",
+                "        raise",
+            ]
+        )
+
+
+def translate(code, source="<arkhe>"):
+    """Returns the source of a Python module that runs code"""
+    instructions = list(Arkhe(list(code)).instructions())
+    starts = leaders(instructions)
+    leader_set = set(starts)
+
+    blocks, block = [], None
+    for offset, instr, end in instructions:
+        if offset in leader_set:
+            if block is not None:
+                blocks.append(block.source(offset, leader_set))
+            block = Block(offset, len(code))
+
+        try:
+            ended = block.translate(instr, end, leader_set)
+        except (IndexError, ValueError):
+            ended = block.generic(instr, end, leader_set)
+
+        if ended:
+            blocks.append(block.source(None, leader_set))
+            block = None
+
+    if block is not None:
+        blocks.append(block.source(instructions[-1][2], leader_set))
+
+    table = ", ".join(f"{start}: block_{start}" for start in starts)
+    return "\n\n\n".join(
+        [
+            HEADER.format(source=source, code=tuple(map(int, code))),
+            *blocks,
+            f"BLOCKS = {{{table}}}\n{RUNTIME}",
+        ]
+    )
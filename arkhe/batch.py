@@ -0,0 +1,393 @@
+"""
+Batched execution of one program over many lanes.
+
+`Batch` runs a program once per lane (every lane with its own initial
+registers) holding the registers, the equality flag, the counter and the
+memory as NumPy columns, one element per lane. An instruction runs at once
+for every lane at its counter; lanes that branch apart are masked and the
+lowest counter runs first, so they meet again where their paths join.
+
+Lanes end up exactly as `Arkhe.eval()` would leave them: ints stay int64
+only while no result can overflow (the column holds Python objects
+otherwise), a fault stops just its lane and is kept in `errors`, and a lane
+reaching something without a batched form (SYMSET, CCALL, vector registers,
+a non-int address...) finishes alone on an `Arkhe` instance.
+"""
+import operator
+
+import numpy
+
+from arkhe.controller import Arkhe
+from arkhe.jit import CONDITIONAL_JUMPS
+from arkhe.vm import HLT, OPERAND_COUNTS, MemoryFault, Operation, load_const
+
+INT64 = numpy.dtype(numpy.int64)
+OBJECT = numpy.dtype(object)
+MAX_INT = 2 ** 63 - 1
+MAX_EXACT = 2 ** 53  # ints that convert to floats exactly
+
+
+def column(values):
+    """Returns values as a lane column of int64, float64 or Python objects"""
+    if isinstance(values, numpy.ndarray):
+        if values.dtype.kind == "i":
+            return values.astype(INT64)
+        elif values.dtype == numpy.float64:
+            return values.copy()
+        return values.astype(OBJECT)
+
+    values = list(values)
+    types = set(map(type, values))
+    if types <= {int}:
+        try:
+            return numpy.array(values, dtype=INT64)
+        except OverflowError:
+            pass
+    elif types == {float}:
+        return numpy.array(values, dtype=numpy.float64)
+    result = numpy.empty(len(values), dtype=OBJECT)
+    result[:] = values
+    return result
+
+
+def put(target, values, lanes):
+    """Stores values into target at lanes, returns the (maybe new) target
+
+    Columns of different types only mix as Python objects, unless every
+    lane is overwritten.
+    """
+    if values.dtype != target.dtype:
+        if len(lanes) == len(target):
+            target = numpy.empty(target.shape, dtype=values.dtype)
+        elif target.dtype != OBJECT:
+            target = target.astype(OBJECT)
+        values = values.astype(target.dtype)
+    target[lanes] = values
+    return target
+
+
+def bound(values):
+    if not len(values):
+        return 0
+    return max(-int(values.min()), int(values.max()))
+
+
+def exact(operation, values):
+    """Returns whether NumPy computes operation over values like Python"""
+    kinds = {value.dtype.kind for value in values}
+    if "O" in kinds or kinds == {"f"}:
+        return True
+
+    if kinds == {"i"}:
+        first, second = map(bound, values)
+        if operation in (Operation.ADD, Operation.SUB):
+            return first + second <= MAX_INT
+        elif operation is Operation.MUL:
+            return first * second <= MAX_INT
+        elif operation is Operation.TRUEDIV:
+            return max(first, second) <= MAX_EXACT
+        return True
+    return all(bound(value) <= MAX_EXACT for value in values if value.dtype.kind == "i")
+
+
+def item(value):
+    return value.item() if isinstance(value, numpy.generic) else value
+
+
+class Batch:
+    instrset = {}
+
+    def __init__(self, code, registers=None, lanes=None, consts=()):
+        """registers maps registers to their initial value in every lane
+
+        lanes defaults to the length of those columns.
+        """
+        registers = dict(registers or {})
+        if lanes is None:
+            lanes = len(next(iter(registers.values()))) if registers else 1
+
+        self.arkhe = Arkhe(code, jit=False, consts=consts)
+        self.size = lanes
+        self.registers = [numpy.zeros(lanes, dtype=INT64) for _ in self.arkhe.registers]
+        for register, values in registers.items():
+            self.arkhe.registers[register]  # raises RegisterNotFound
+            values = column(values)
+            if len(values) != lanes:
+                raise ValueError(f"r{register} has {len(values)} values for {lanes} lanes")
+            self.registers[register] = values
+
+        self.flags = numpy.zeros(lanes, dtype=bool)
+        self.counters = numpy.zeros(lanes, dtype=INT64)
+        self.active = numpy.ones(lanes, dtype=bool)  # not faulted or escaped
+        self.cells = numpy.zeros((lanes, 0), dtype=INT64)
+        self.heads = numpy.zeros(lanes, dtype=INT64)
+        self.sizes = numpy.zeros(lanes, dtype=INT64)
+        self.errors = {}
+        self.pc = 0
+        self.decoded = {}
+
+    @classmethod
+    def instr(cls, instr):
+        def wrapper(f):
+            cls.instrset[instr] = f
+            return f
+
+        return wrapper
+
+    def eval(self):
+        eta = len(self.arkhe.code)
+        while True:
+            live = self.active & (self.counters < eta)
+            if not live.any():
+                break
+            pc = int(self.counters[live].min())
+            self.step(pc, numpy.flatnonzero(live & (self.counters == pc)))
+
+    def step(self, pc, lanes):
+        try:
+            handler, instr, end = self.decoded[pc]
+        except KeyError:
+            try:
+                instr, end = self.arkhe.decode(pc)
+            except Exception as exc:
+                return self.fault(lanes, exc)
+            handler = self.instrset.get(instr.operation)
+            if len(instr.operands) < OPERAND_COUNTS[instr.operation][0]:
+                handler = None  # let the VM raise it
+            self.decoded[pc] = handler, instr, end
+
+        if handler is None:
+            return self.escape(lanes, pc)
+        self.pc = pc
+        self.counters[lanes] = end
+        handler(self, instr, lanes, end)
+
+    def fault(self, lanes, exc):
+        for lane in lanes.tolist():
+            self.errors[lane] = exc
+        self.active[lanes] = False
+
+    def escape(self, lanes, pc):
+        """Runs lanes to the end one by one, starting from pc"""
+        for lane in lanes.tolist():
+            vm = Arkhe(
+                self.arkhe.code, consts=self.arkhe.consts, bindings=self.arkhe.bindings
+            )
+            vm.registers.data[:] = self.lane(lane)
+            vm.memory.alloc(int(self.sizes[lane]))
+            vm.memory.write(0, self.memory(lane))
+            vm.counter, vm._eqflag = pc, bool(self.flags[lane])
+            try:
+                vm.eval()
+            except Exception as exc:
+                self.errors[lane] = exc
+
+            index = numpy.array([lane])
+            for register, value in enumerate(vm.registers.data):
+                self.store(register, column([value]), index)
+            self.flags[lane] = vm._eqflag
+            self.counters[lane] = vm.counter
+            self.active[lane] = False
+
+            cells = column(list(vm.memory))
+            self.heads[lane] = 0
+            self.resize(index, [len(cells)])
+            self.cells[lane, : len(cells)] = self.widen(cells)
+
+    def apply(self, operation, lanes, *registers):
+        """Returns (lanes, results) of operation over the registers' values
+
+        Lanes where it raises are faulted and left out.
+        """
+        func = getattr(operator, operation.name.lower())
+        values = [self.registers[register][lanes] for register in registers]
+        if exact(operation, values):
+            try:
+                with numpy.errstate(all="raise"):
+                    return lanes, func(*values)
+            except (ArithmeticError, TypeError):
+                pass  # like Python, lane by lane
+
+        done, results = [], []
+        for lane, args in zip(lanes.tolist(), zip(*(v.tolist() for v in values))):
+            try:
+                results.append(func(*args))
+            except Exception as exc:
+                self.fault(numpy.array([lane]), exc)
+            else:
+                done.append(lane)
+        return numpy.array(done, dtype=numpy.intp), column(results)
+
+    def integers(self, lanes, register):
+        """Returns (lanes, values) of a register holding ints in int64,
+        other lanes escape"""
+        values = self.registers[register][lanes]
+        if values.dtype == INT64:
+            return lanes, values
+
+        fits = numpy.array(
+            [type(value) is int and -MAX_INT <= value <= MAX_INT for value in values],
+            dtype=bool,
+        )
+        self.escape(lanes[~fits], self.pc)
+        return lanes[fits], values[fits].astype(INT64)
+
+    def store(self, register, values, lanes):
+        self.registers[register] = put(self.registers[register], values, lanes)
+
+    def resize(self, lanes, sizes):
+        """Sets the memory size of lanes, new cells are 0"""
+        sizes = numpy.asarray(sizes, dtype=INT64)
+        capacity = int((self.heads[lanes] + sizes).max(initial=0))
+        if capacity > self.cells.shape[1]:
+            grown = numpy.zeros((self.size, capacity), dtype=self.cells.dtype)
+            grown[:, : self.cells.shape[1]] = self.cells
+            self.cells = grown
+
+        start = self.heads[lanes] + numpy.minimum(self.sizes[lanes], sizes)
+        end = self.heads[lanes] + sizes
+        positions = numpy.arange(self.cells.shape[1])
+        rows = self.cells[lanes]
+        rows[(positions >= start[:, None]) & (positions < end[:, None])] = 0
+        self.cells[lanes] = rows
+        self.sizes[lanes] = sizes
+
+    def widen(self, values):
+        """Returns values in the type of the memory, which holds Python
+        objects once anything but int64 is stored"""
+        if values.dtype != self.cells.dtype:
+            if self.cells.dtype != OBJECT:
+                self.cells = self.cells.astype(OBJECT)
+            values = values.astype(OBJECT)
+        return values
+
+    def addresses(self, lanes, register, message):
+        """Returns (lanes, positions) of the memory indexes in register,
+        lanes with indexes out of their memory fault"""
+        lanes, positions = self.integers(lanes, register)
+        sizes = self.sizes[lanes]
+        positions = numpy.where(positions < 0, positions + sizes, positions)
+        owned = (positions >= 0) & (positions < sizes)
+        if not owned.all():
+            self.fault(lanes[~owned], MemoryFault(message))
+        return lanes[owned], positions[owned]
+
+    def lane(self, lane):
+        """Returns the registers of lane"""
+        return [item(values[lane]) for values in self.registers]
+
+    def results(self):
+        """Returns the registers of every lane"""
+        return [list(row) for row in zip(*(values.tolist() for values in self.registers))]
+
+    def memory(self, lane):
+        head = int(self.heads[lane])
+        return self.cells[lane, head : head + int(self.sizes[lane])].tolist()
+
+    def __repr__(self):
+        return f"Batch of {self.size} lanes"
+
+
+@Batch.instr(Operation.LOAD)
+def load(batch, instr, lanes, end):
+    try:
+        value = load_const(instr, batch.arkhe.consts)
+    except Exception as exc:
+        return batch.fault(lanes, exc)
+    batch.store(instr.operands[0], column([value]), lanes)
+
+
+@Batch.instr(Operation.ADD)
+@Batch.instr(Operation.SUB)
+@Batch.instr(Operation.MUL)
+@Batch.instr(Operation.TRUEDIV)
+def math(batch, instr, lanes, end):
+    operand1, operand2, target = instr.operands[:3]
+    lanes, values = batch.apply(instr.operation, lanes, operand1, operand2)
+    batch.store(target, column(values), lanes)
+
+
+@Batch.instr(Operation.EQ)
+@Batch.instr(Operation.NE)
+@Batch.instr(Operation.LE)
+@Batch.instr(Operation.GE)
+@Batch.instr(Operation.GT)
+@Batch.instr(Operation.LT)
+def comparison(batch, instr, lanes, end):
+    operand1, operand2 = instr.operands[:2]
+    lanes, values = batch.apply(instr.operation, lanes, operand1, operand2)
+    batch.flags[lanes] = values
+
+
+@Batch.instr(Operation.JMP)
+@Batch.instr(Operation.JMPF)
+@Batch.instr(Operation.JMPB)
+@Batch.instr(Operation.JEQ)
+@Batch.instr(Operation.JNE)
+@Batch.instr(Operation.JFE)
+@Batch.instr(Operation.JFN)
+def jump(batch, instr, lanes, end):
+    operation = instr.operation
+    lanes, values = batch.integers(lanes, instr.operands[0])
+    if operation in CONDITIONAL_JUMPS:
+        relative, on_flag = CONDITIONAL_JUMPS[operation]
+        taken = batch.flags[lanes] == on_flag
+        lanes, values = lanes[taken], values[taken]
+        batch.counters[lanes] = end + values if relative else values
+    elif operation is Operation.JMPF:
+        batch.counters[lanes] = end + values
+    elif operation is Operation.JMPB:
+        batch.counters[lanes] = end - values
+    else:
+        batch.counters[lanes] = values
+
+
+@Batch.instr(Operation.ALLOC)
+def mem_alloc(batch, instr, lanes, end):
+    lanes, amounts = batch.integers(lanes, instr.operands[0])
+    growing = amounts > 0
+    lanes = lanes[growing]
+    batch.resize(lanes, batch.sizes[lanes] + amounts[growing])
+
+
+@Batch.instr(Operation.DEALLOC)
+def mem_dealloc(batch, instr, lanes, end):
+    head = instr.operands[0]
+    lanes, amounts = batch.integers(lanes, instr.operands[1])
+    owned = amounts <= batch.sizes[lanes]
+    if not owned.all():
+        batch.fault(lanes[~owned], MemoryFault("Deallocation of not owned area!"))
+    shrinking = owned & (amounts > 0)
+    lanes, amounts = lanes[shrinking], amounts[shrinking]
+
+    batch.sizes[lanes] -= amounts
+    if head:
+        batch.heads[lanes] += amounts
+    batch.heads[lanes[batch.sizes[lanes] == 0]] = 0
+
+
+@Batch.instr(Operation.INSERT)
+def mem_insert(batch, instr, lanes, end):
+    position, value = instr.operands[:2]
+    lanes, positions = batch.addresses(
+        lanes, position, "Insert operation to not owned area!"
+    )
+    values = batch.widen(batch.registers[value][lanes])
+    batch.cells[lanes, batch.heads[lanes] + positions] = values
+
+
+@Batch.instr(Operation.READ)
+def mem_read(batch, instr, lanes, end):
+    position, target = instr.operands[:2]
+    lanes, positions = batch.addresses(lanes, position, "Read operation to not owned area!")
+    batch.store(target, column(batch.cells[lanes, batch.heads[lanes] + positions]), lanes)
+
+
+@Batch.instr(Operation.NOP)
+def nop(batch, instr, lanes, end):
+    pass
+
+
+@Batch.instr(Operation.HLT)
+def hlt(batch, instr, lanes, end):
+    batch.fault(lanes, HLT())
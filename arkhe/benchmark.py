@@ -0,0 +1,88 @@
+"""
+Loop benchmarks for the execution engines.
+
+    python -m arkhe.benchmark [iterations]
+
+Runs every program with the generic interpreter and the threaded engine with
+and without fused pairs, and prints the best of a few runs.
+"""
+import sys
+from time import perf_counter
+
+from arkhe.controller import Arkhe
+from arkhe.utils import create_instr
+
+ITERATIONS = 60_000
+REPEAT = 5
+
+
+def countdown(n):
+    """Sums n..1 into r3, a compare + branch per iteration"""
+    return [
+        *create_instr("load", 0, n >> 8, n & 0xFF),
+        *create_instr("load", 1, 0, 1),
+        *create_instr("load", 2, 0, 0),
+        *create_instr("load", 4, 0, 20),
+        *create_instr("load", 5, 0, 3),
+        *create_instr("add", 3, 0, 3),
+        *create_instr("sub", 0, 1, 0),
+        *create_instr("gt", 0, 2),
+        *create_instr("jfn", 5),
+        *create_instr("jmpb", 4),
+    ]
+
+
+def immediates(n):
+    """Adds 3 to r3 n times, reloading the immediates in every iteration"""
+    return [
+        *create_instr("load", 0, n >> 8, n & 0xFF),
+        *create_instr("load", 2, 0, 0),
+        *create_instr("load", 4, 0, 33),
+        *create_instr("load", 5, 0, 3),
+        *create_instr("load", 1, 0, 1),
+        *create_instr("sub", 0, 1, 0),
+        *create_instr("load", 6, 0, 3),
+        *create_instr("add", 3, 6, 3),
+        *create_instr("lt", 2, 0),
+        *create_instr("jfe", 5),
+        *create_instr("jmpf", 5),
+        *create_instr("jmpb", 4),
+    ]
+
+
+PROGRAMS = {"countdown": countdown, "immediates": immediates}
+MODES = {
+    "generic": dict(jit=False),
+    "threaded": dict(engine="threaded"),
+    "fused": dict(engine="threaded"),
+}
+
+
+def measure(code, mode):
+    best = None
+    for _ in range(REPEAT):
+        vm = Arkhe(code, **MODES[mode])
+        if mode == "threaded":
+            vm.engine.fuse_pairs = False
+        start = perf_counter()
+        vm.eval()
+        elapsed = perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    iterations = int(argv[0]) if argv else ITERATIONS
+    for name, program in PROGRAMS.items():
+        code = program(min(iterations, 0xFFFF))
+        timings = {mode: measure(code, mode) for mode in MODES}
+        print(
+            f"{name:<12}",
+            *(f"{mode} {timing:.3f}s" for mode, timing in timings.items()),
+            f"fused speedup {timings['threaded'] / timings['fused']:.2f}x",
+        )
+
+
+if __name__ == "__main__":
+    main()
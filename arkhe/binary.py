@@ -0,0 +1,132 @@
+"""
+Binary program container (.arkc)
+
+Layout (little endian):
+    header  magic b"ARKC", version u16, flags u16, code words u32, pool size u32
+    code    code words * uint16
+    pool    pool size bytes of constants, each a tag u8, length u32 and payload
+
+The code section starts right after the 16 byte header so a mapped file can
+be handed to `Arkhe` as a memoryview without copying it.
+"""
+import mmap
+import struct
+import sys
+from array import array
+from dataclasses import dataclass, field
+from typing import Any, List, Sequence
+
+from arkhe.vm import ArkheException
+
+MAGIC = b"ARKC"
+VERSION = 1
+HEADER = struct.Struct("<4sHHII")
+CONST = struct.Struct("<BI")
+
+CONST_INT = 0
+CONST_STR = 1
+CONST_BYT = 2
+
+
+class InvalidProgram(ArkheException):
+    pass
+
+
+@dataclass
+class Program:
+    code: Sequence[int]
+    consts: List[Any] = field(default_factory=list)
+
+
+def dumps(code, consts=()):
+    try:
+        words = array("H", code)
+    except OverflowError:
+        raise InvalidProgram("Code words must fit into 16 bits!")
+    if sys.byteorder != "little":
+        words.byteswap()
+
+    pool = b"".join(map(pack_const, consts))
+    header = HEADER.pack(MAGIC, VERSION, 0, len(words), len(pool))
+    return header + words.tobytes() + pool
+
+
+def dump(code, file, consts=()):
+    file.write(dumps(code, consts))
+
+
+def loads(data):
+    """Reads a program from a bytes-like object, the code refers to data"""
+    view = memoryview(data)
+    magic, version, _, words, pool_size = unpack_header(view)
+    start, end = HEADER.size, HEADER.size + words * 2
+    if len(view) < end + pool_size:
+        raise InvalidProgram("Program is truncated!")
+
+    if sys.byteorder == "little":
+        code = view[start:end].cast("H")
+    else:
+        code = array("H", view[start:end])
+        code.byteswap()
+
+    return Program(code, unpack_consts(view[end : end + pool_size]))
+
+
+def load(file):
+    return loads(file.read())
+
+
+def load_mapped(path):
+    """Maps the program at path into memory, its code isn't copied"""
+    with open(path, "rb") as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return loads(mapped)
+
+
+def unpack_header(view):
+    if len(view) < HEADER.size:
+        raise InvalidProgram("Program is truncated!")
+
+    header = HEADER.unpack(view[: HEADER.size])
+    if header[0] != MAGIC:
+        raise InvalidProgram("Not an Arkhe program!")
+    if header[1] != VERSION:
+        raise InvalidProgram(f"Unsupported program version {header[1]}!")
+    return header
+
+
+def pack_const(value):
+    if isinstance(value, int):
+        tag = CONST_INT
+        payload = value.to_bytes(
+            (value.bit_length() + 8) // 8, "little", signed=True
+        )
+    elif isinstance(value, str):
+        tag, payload = CONST_STR, value.encode("utf8")
+    elif isinstance(value, bytes):
+        tag, payload = CONST_BYT, value
+    else:
+        raise InvalidProgram(f"Can't store {type(value).__name__} constants!")
+    return CONST.pack(tag, len(payload)) + payload
+
+
+def unpack_consts(view):
+    consts, offset = [], 0
+    while offset < len(view):
+        if offset + CONST.size > len(view):
+            raise InvalidProgram("Program is truncated!")
+        tag, size = CONST.unpack(view[offset : offset + CONST.size])
+        offset += CONST.size
+        if offset + size > len(view):
+            raise InvalidProgram("Program is truncated!")
+        payload = bytes(view[offset : offset + size])
+        offset += size
+        if tag == CONST_INT:
+            consts.append(int.from_bytes(payload, "little", signed=True))
+        elif tag == CONST_STR:
+            consts.append(payload.decode("utf8"))
+        elif tag == CONST_BYT:
+            consts.append(payload)
+        else:
+            raise InvalidProgram(f"Unknown constant tag {tag}!")
+    return consts
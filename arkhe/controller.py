@@ -1,8 +1,30 @@
-import itertools
-from collections import UserDict, UserList
-from functools import partial
+from collections.abc import Mapping, MutableMapping
+from time import monotonic
 
-from arkhe.vm import INSTR_TERM, VM, ArkheException, Instr, Operation
+from arkhe.engine import ENGINES
+from arkhe.ffi import Bindings
+from arkhe.jit import Tracer
+from arkhe.memory import Memory
+from arkhe.pool import ConstantPool
+from arkhe.verifier import verify
+from arkhe.vm import (
+    INSTR_TERM,
+    JUMP_OPS,
+    REGISTER_OPERANDS,
+    UNSET,
+    VECTOR_OPERANDS,
+    VECTOR_REGISTERS,
+    VM,
+    ArkheException,
+    BudgetExceeded,
+    Instr,
+    Operation,
+    Switch,
+    ThreadError,
+)
+
+SWITCH_EVERY = 100  # instructions a green thread runs before the next one
+CHECK_EVERY = 1024  # instructions between deadline checks
 
 
 class RegisterNotFound(ArkheException):
@@ -13,67 +35,488 @@ class InstrNotEnded(ArkheException):
     pass
 
 
-class Registers(UserDict):
+class Registers(Mapping):
+    """Fixed size register file over a plain list
+
+    Item access is checked, the VM handlers index `data` directly since
+    register operands are validated when instructions are decoded.
+    """
+
+    __slots__ = ("data",)
+
     def __init__(self, amount=32):
-        self.data = dict(zip(range(amount), itertools.repeat(0, amount)))
+        self.data = [0] * amount
+
+    def _check(self, register):
+        register = int(register)
+        if not 0 <= register < len(self.data):
+            raise RegisterNotFound(f"{register}")
+        return register
+
+    def __getitem__(self, register):
+        return self.data[self._check(register)]
 
     def __setitem__(self, register, value):
+        self.data[self._check(register)] = value
+
+    def __iter__(self):
+        return iter(range(len(self.data)))
+
+    def __len__(self):
+        return len(self.data)
+
+
+class Vectors(Mapping):
+    """Bank of vector registers holding one dimensional NumPy arrays
+
+    Registers are None until set, the VM reads them as empty vectors. NumPy
+    is only imported once a vector opcode runs.
+    """
+
+    __slots__ = ("data", "_numpy")
+
+    def __init__(self, amount=VECTOR_REGISTERS):
+        self.data = [None] * amount
+        self._numpy = None
+
+    @property
+    def numpy(self):
+        if self._numpy is None:
+            import numpy
+
+            self._numpy = numpy
+        return self._numpy
+
+    def _check(self, register):
         register = int(register)
-        if self.get(register) is None:
+        if not 0 <= register < len(self.data):
+            raise RegisterNotFound(f"v{register}")
+        return register
+
+    def __getitem__(self, register):
+        return self.data[self._check(register)]
+
+    def __setitem__(self, register, value):
+        self.data[self._check(register)] = self.numpy.asarray(value)
+
+    def __iter__(self):
+        return iter(range(len(self.data)))
+
+    def __len__(self):
+        return len(self.data)
+
+
+def check_registers(instr, amount, vectors=VECTOR_REGISTERS):
+    """Raises RegisterNotFound if instr names a register out of the file
+    (or a vector register out of the vector bank)"""
+    positions = REGISTER_OPERANDS.get(instr.operation, ())
+    if positions is None:
+        operands = instr.operands
+    else:
+        operands = [instr.operands[n] for n in positions if n < len(instr.operands)]
+
+    for register in operands:
+        if not 0 <= register < amount:
             raise RegisterNotFound(f"{register}")
-        return super().__setitem__(register, value)
 
+    for n in VECTOR_OPERANDS.get(instr.operation, ()):
+        if n < len(instr.operands) and not 0 <= instr.operands[n] < vectors:
+            raise RegisterNotFound(f"v{instr.operands[n]}")
 
-class Symtable(UserDict):
-    pass
 
+class GreenThread:
+    """State of a thread while another one runs (see Arkhe.schedule)
+
+    The running thread's counter, flag and registers live in the VM itself,
+    so its registers and vectors are None here.
+    """
+
+    __slots__ = ("counter", "flag", "registers", "vectors", "waiting")
+
+    def __init__(self, counter, registers=None, vectors=None):
+        self.counter = counter
+        self.flag = False
+        self.registers = registers
+        self.vectors = vectors
+        self.waiting = None  # the thread it JOINs
+
+    def __repr__(self):
+        return f"GreenThread at {self.counter}"
+
+
+class Budget:
+    """Instruction and time limits of an eval() call
+
+    The interpreter charges it on backward jumps: a jump back to target pays
+    for the instructions from target up to the jump, one iteration of the
+    loop it closes. Code between two backward jumps only runs forward, so
+    that bounds a program without counting every instruction. Traces and the
+    threaded engine take fuel, what's left until the next check, in chunks
+    and call refill() once they overdraw it. The deadline is checked every
+    CHECK_EVERY charged instructions.
+    """
+
+    def __init__(self, arkhe, instructions=None, seconds=None):
+        self.arkhe = arkhe
+        self.instructions = instructions
+        self.seconds = seconds
+        self.left = instructions
+        self.deadline = None if seconds is None else monotonic() + seconds
+        self.costs = {}
+        self.chunk = self.fuel = 0
+        self.refill()
+
+    def charge(self, target, source):
+        """Charges the backward jump at source to target"""
+        try:
+            cost = self.costs[target, source]
+        except KeyError:
+            cost = self.costs[target, source] = self.measure(target, source)
+        self.spend(cost)
+
+    def spend(self, instructions):
+        self.fuel -= instructions
+        if self.fuel < 0:
+            self.refill()
+
+    def measure(self, target, source):
+        """Number of instructions from target up to the jump at source"""
+        offset, cost, instr = target, 0, None
+        while offset <= source:
+            try:
+                instr, offset = self.arkhe.decode(offset)
+            except (ValueError, ArkheException):
+                break
+            cost += 1
+        if instr is not None and instr.operation not in JUMP_OPS:
+            cost += 1  # a fused compare + jump pair starts at source
+        return max(cost, 1)
+
+    def refill(self):
+        """Accounts for the spent fuel, raises BudgetExceeded if the budget
+        ran out"""
+        spent = self.chunk - self.fuel
+        if self.left is not None:
+            self.left -= spent
+            if self.left < 0:
+                raise BudgetExceeded(f"Executed {self.instructions} instructions!")
+        if self.deadline is not None and monotonic() > self.deadline:
+            raise BudgetExceeded(f"Ran out of {self.seconds} seconds!")
+        self.chunk = CHECK_EVERY if self.left is None else min(self.left, CHECK_EVERY)
+        self.fuel = self.chunk
 
-class Memory(UserList):
-    def alloc(self, amount):
-        self.data.extend(itertools.repeat(0, amount))
 
-    def dealloc(self, amount, head):
-        p = partial(self.data.pop, 0 if head else -1)
-        for _ in range(amount):
-            p()
+class Symtable(MutableMapping):
+    """Symbol table that resolves names to slots
+
+    Every name gets a fixed slot in `values` the first time it is seen, so
+    SYMSET/SYMREAD can cache the slot and skip hashing the name. Slots of
+    names that aren't set hold UNSET. As a mapping it behaves like a dict.
+    """
+
+    __slots__ = ("slots", "values", "names", "_order")
+
+    def __init__(self, *args, **kwargs):
+        self.slots = {}
+        self.values = []
+        self.names = []
+        self._order = {}  # names that are set, in insertion order
+        self.update(*args, **kwargs)
+
+    def slot(self, name):
+        slot = self.slots.get(name)
+        if slot is None:
+            slot = self.slots[name] = len(self.values)
+            self.values.append(UNSET)
+            self.names.append(name)
+        return slot
+
+    def store(self, slot, value):
+        if self.values[slot] is UNSET:
+            self._order[self.names[slot]] = None
+        self.values[slot] = value
+
+    def __getitem__(self, name):
+        slot = self.slots.get(name)
+        if slot is None or self.values[slot] is UNSET:
+            raise KeyError(name)
+        return self.values[slot]
+
+    def __setitem__(self, name, value):
+        self.store(self.slot(name), value)
+
+    def __delitem__(self, name):
+        slot = self.slots.get(name)
+        if slot is None or self.values[slot] is UNSET:
+            raise KeyError(name)
+        self.values[slot] = UNSET
+        del self._order[name]
+
+    def __iter__(self):
+        return iter(self._order)
+
+    def __len__(self):
+        return len(self._order)
+
+    def __repr__(self):
+        return repr(dict(self))
 
 
 class Arkhe:
-    def __init__(self, code=None):
+    def __init__(
+        self,
+        code=None,
+        engine=None,
+        jit=True,
+        memory=None,
+        verify=False,
+        consts=(),
+        bindings=None,
+    ):
+        self.engine = None
+        self.jit = None
         self.code = code or []
 
         self.registers = Registers(32)
-        self.memory = Memory()
+        self.vectors = Vectors(VECTOR_REGISTERS)
+        self.memory = Memory() if memory is None else memory
         self.symtable = Symtable()
+        if not isinstance(consts, ConstantPool):
+            consts = ConstantPool(consts)
+        self.consts = consts
+        self.bindings = Bindings() if bindings is None else bindings
         self.machine = VM(self)
 
         self.counter = 0
         self._eqflag = False
+        self.threads = {}  # id: GreenThread, empty until the first SPAWN
+        self.thread = 0
+        self.switch_every = SWITCH_EVERY
+        self.budget = None  # the running eval()'s Budget
+
+        if engine is not None:
+            self.engine = ENGINES[engine](self)
+        elif jit:
+            self.jit = Tracer(self)
+
+        if verify:
+            self.verify()
+
+    @property
+    def code(self):
+        return self._code
+
+    @code.setter
+    def code(self, code):
+        self._code = code
+        self._decoded = {}
+        self._decoded_upto = 0
+        if self.engine is not None:
+            self.engine.reset()
+        if self.jit is not None:
+            self.jit.reset()
+
+    def verify(self):
+        """Verifies the whole program up front (see arkhe.verifier)
+
+        The verified instructions become the decode table, so running them
+        doesn't check them again.
+        """
+        self._decoded = verify(
+            self.code, len(self.registers), self.consts, len(self.vectors)
+        )
+        self._decoded_upto = len(self.code)
+
+    def eval(self, instructions=None, seconds=None):
+        """Runs the program (every green thread) to the end
+
+        A single thread runs on the engine, the JIT or the interpreter. Once
+        a SPAWN leaves that loop, threads take turns of switch_every
+        instructions (or until they YIELD or JOIN) until all of them end.
+
+        With an instructions or seconds budget, BudgetExceeded is raised once
+        it runs out (see Budget), leaving the VM between two instructions so
+        eval() can be called again to go on.
+        """
+        if instructions is None and seconds is None:
+            return self._eval()
+        self.budget = Budget(self, instructions, seconds)
+        try:
+            return self._eval()
+        finally:
+            self.budget = None
 
-    def eval(self):
+    def _eval(self):
         eta = len(self.code)
-        while self.counter < eta:
-            self.exc_instr()
+        budget = self.budget
+        while not self.threads:
+            try:
+                if self.engine is not None:
+                    return self.engine.run()
+                if self.jit is not None:
+                    return self.jit.run()
+                while self.counter < eta:
+                    pc = self.counter
+                    self.machine.dispatch(self.next_instr())
+                    if self.counter <= pc and budget is not None:
+                        budget.charge(self.counter, pc)
+                return
+            except Switch:
+                self.schedule()
+
+        running = True
+        while running:
+            executed = 0
+            while executed < self.switch_every and self.counter < eta:
+                self.exc_instr()
+                executed += 1
+            if budget is not None:
+                budget.spend(executed)  # threads are metered per turn
+            running = self.schedule()
 
     def exc_instr(self):
-        instr = self.next_instr()
-        return self.machine.dispatch(instr)
+        try:
+            if self.engine is not None:
+                self.engine.step()
+            else:
+                self.machine.dispatch(self.next_instr())
+        except Switch:
+            self.schedule()
+            return
+        if self.threads and self.counter >= len(self.code):
+            self.schedule()  # the thread ended, run the next one
+
+    def spawn(self, counter):
+        """Creates a thread that starts at counter with a copy of the
+        current registers, returns its id"""
+        if not self.threads:
+            self.threads[0] = GreenThread(self.counter)
+        thread = len(self.threads)
+        self.threads[thread] = GreenThread(
+            counter, list(self.registers.data), list(self.vectors.data)
+        )
+        return thread
+
+    def finished(self, thread):
+        """Whether thread ran to the end (and isn't waiting in a last JOIN)"""
+        state = self.threads[thread]
+        counter = self.counter if thread == self.thread else state.counter
+        return counter >= len(self.code) and state.waiting is None
+
+    def schedule(self):
+        """Switches to the next thread that can run, in round robin order
+
+        Returns False once every thread ended, then the main thread (0) is
+        loaded back and the thread table is cleared. Raises ThreadError if
+        the remaining threads all JOIN unfinished ones.
+        """
+        if not self.threads:
+            return self.counter < len(self.code)
+
+        order = list(self.threads)
+        start = order.index(self.thread) + 1
+        for thread in order[start:] + order[:start]:
+            state = self.threads[thread]
+            if self.finished(thread):
+                continue
+            if state.waiting is not None:
+                if not self.finished(state.waiting):
+                    continue
+                state.waiting = None
+            self._switch(thread)
+            return True
+
+        if all(map(self.finished, order)):
+            self._switch(0)
+            self.threads.clear()
+            return False
+        raise ThreadError("Threads deadlocked!")
+
+    def _switch(self, thread):
+        """Saves the running thread and loads thread's state
+
+        Register values are copied in place since the engines bind the lists.
+        """
+        if thread == self.thread:
+            return
+        current, state = self.threads[self.thread], self.threads[thread]
+        current.counter, current.flag = self.counter, self._eqflag
+        current.registers = list(self.registers.data)
+        current.vectors = list(self.vectors.data)
+        self.registers.data[:] = state.registers
+        self.vectors.data[:] = state.vectors
+        self.counter, self._eqflag = state.counter, state.flag
+        state.registers = state.vectors = None
+        self.thread = thread
 
     def next_instr(self):
-        operation = Operation(self.code[self.counter])
-        self.counter += 1
+        try:
+            instr, end = self._decoded[self.counter]
+        except KeyError:
+            instr, end = self.decode(self.counter)
 
-        operands = []
-        for item in self.code[self.counter :]:
-            if item != INSTR_TERM:
-                operands.append(item)
-            else:
-                break
-        else:
+        instr.op = 0
+        self.counter = end
+        return instr
+
+    def decode(self, offset):
+        """Returns the decoded (instr, end) pair at offset, caching it.
+
+        Code appended since the last call is decoded linearly first, so
+        growing the program (as ADB does) only costs the new part. Offsets
+        that aren't instruction boundaries (e.g a jump into operands) are
+        decoded on their own.
+        """
+        if offset >= self._decoded_upto:
+            self._decode_tail()
+            if offset in self._decoded:
+                return self._decoded[offset]
+
+        entry = self._decoded[offset] = self._decode_at(offset)
+        return entry
+
+    def instructions(self):
+        """Yields (offset, instr, end) for the program from its start
+
+        Stops before the first offset that can't be decoded.
+        """
+        self._decode_tail()
+        offset = 0
+        while offset < self._decoded_upto:
+            instr, end = self._decoded[offset]
+            yield offset, instr, end
+            offset = end
+
+    def _decode_tail(self):
+        offset, eta = self._decoded_upto, len(self.code)
+        while offset < eta:
+            try:
+                entry = self._decode_at(offset)
+            except (ValueError, ArkheException):
+                break  # raised again if the counter ever reaches there
+            self._decoded[offset] = entry
+            offset = entry[1]
+        self._decoded_upto = offset
+
+    def _decode_at(self, offset):
+        operation = Operation(self.code[offset])
+        try:
+            end = self._find_term(offset + 1)
+        except ValueError:
             raise InstrNotEnded()
 
-        self.counter += len(operands) + 1
-        return Instr(operation, operands)
+        instr = Instr(operation, list(self.code[offset + 1 : end]))
+        check_registers(instr, len(self.registers), len(self.vectors))
+        return instr, end + 1
+
+    def _find_term(self, start):
+        try:
+            return self.code.index(INSTR_TERM, start)
+        except AttributeError:  # memoryviews (e.g over mapped programs)
+            for end in range(start, len(self.code)):
+                if self.code[end] == INSTR_TERM:
+                    return end
+            raise ValueError(INSTR_TERM)
 
     def __repr__(self):
         return f"Arkhe at {self.counter}"
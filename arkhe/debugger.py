@@ -6,7 +6,7 @@ from functools import partial
 from itertools import chain
 
 from arkhe.controller import Arkhe
-from arkhe.lang.compiler import ParseError, Parser
+from arkhe.lang.compiler import ParseError, Parser, UnexpectedInput
 from arkhe.utils import divide_sequence
 from arkhe.vm import INSTR_TERM, Instr
 
@@ -42,7 +42,7 @@ class Text:
 class ADB:
     def __init__(self, stdout=sys.stdout):
         self.vm = Arkhe()
-        self.parse = Parser()
+        self.parse = Parser(cache=False)
         self.stdout = stdout
 
     def run(self, ps1=">>> "):
@@ -96,13 +96,25 @@ class ADB:
                 reg = command[1:]
                 print(f"r{reg} = {self.vm.registers[int(reg)]}")
 
+            elif command == "vregs":
+                useds = [
+                    (reg, val) for reg, val in self.vm.vectors.items() if val is not None
+                ]
+                print("Vector register states:")
+                Text["blue"](f"\tTotal: {len(self.vm.vectors)}")
+                Text["warn"](f"\tUseds: {len(useds)}")
+                for reg, val in useds:
+                    print(f"v{reg} = {val} ({val.dtype}, {len(val)} lanes)")
+
+            elif command.startswith("v") and command[1:].isnumeric():
+                reg = command[1:]
+                print(f"v{reg} = {self.vm.vectors[int(reg)]}")
+
             elif command == "mem":
                 total = len(self.vm.memory)
-                nonzero = len([0 for chunk in self.vm.memory if chunk])
-                zero = total - nonzero
+                resident = self.vm.memory.resident
                 Text["blue"](f"Allocated memory: {total}")
-                Text["warn"](f"Non-zero  memory: {nonzero}")
-                Text["green"](f"Free      memory: {zero}")
+                Text["warn"](f"Resident  memory: {resident}")
                 
             elif command == "eq":
                 if self.vm._eqflag:
@@ -149,7 +161,7 @@ class ADB:
                     else:
                         commands = self.parse(command)
                         self.vm.code.extend(commands)
-                except ParseError as exc:
+                except (ParseError, UnexpectedInput) as exc:
                     Text["fail"]("Last instruction couldn't parsed!")
 
 
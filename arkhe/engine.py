@@ -0,0 +1,474 @@
+"""
+Closure-threaded execution engine.
+
+Every instruction is compiled once (on first execution) into a closure with
+its operands, register indices and operator already bound. A closure takes
+the Arkhe instance and returns the next counter, so the hot loop is just
+`pc = handlers[pc](vm)`. Operations without a specializer (or instructions
+that a specializer can't prove safe) fall back to the VM's generic handler.
+
+`run` also fuses common pairs (compare + conditional jump, LOAD + math) into
+one closure. A fused pair leaves the registers, `_eqflag` and the counter
+exactly as the two instructions would, including when it faults; `step`
+always runs one instruction. Under an eval() budget, `run` calls the handlers
+in chunks as long as the budget's fuel and charges a chunk at once, a fused
+pair counting as one instruction.
+"""
+import operator
+from itertools import product, repeat
+
+from arkhe.jit import CONDITIONAL_JUMPS
+from arkhe.vm import (
+    COMPARISON_OPS,
+    HLT,
+    MATH_OPS,
+    UNSET,
+    ArkheException,
+    BudgetExceeded,
+    MemoryFault,
+    Operation,
+    UnknownSymbol,
+    load_const,
+)
+
+
+class Ended(Exception):
+    """Raised for handlers past the end of the program, where the budgeted
+    run loop stops (the other loops check the counter instead)"""
+
+
+class Handlers(dict):
+    def __init__(self, engine):
+        self.engine = engine
+
+    def __missing__(self, pc):
+        if pc >= len(self.engine.arkhe.code):
+            raise Ended()
+        handler = self[pc] = self.engine.compile(pc)
+        return handler
+
+
+class Fused(Handlers):
+    def __missing__(self, pc):
+        if pc >= len(self.engine.arkhe.code):
+            raise Ended()
+        handler = self[pc] = self.engine.fuse(pc)
+        return handler
+
+
+class Threaded:
+    specializers = {}
+    fusers = {}
+
+    def __init__(self, arkhe, fuse=True):
+        self.arkhe = arkhe
+        self.fuse_pairs = fuse
+        self.reset()
+
+    @classmethod
+    def specializer(cls, operation):
+        def wrapper(f):
+            cls.specializers[operation] = f
+            return f
+
+        return wrapper
+
+    @classmethod
+    def fuser(cls, firsts, seconds):
+        def wrapper(f):
+            for pair in product(firsts, seconds):
+                cls.fusers[pair] = f
+            return f
+
+        return wrapper
+
+    def reset(self):
+        self.handlers = Handlers(self)
+        self.fused = Fused(self)
+        self.ends = {}
+        self.fault_ends = {}
+
+    def compile(self, pc):
+        instr, end = self.arkhe.decode(pc)
+        handler = None
+        specializer = self.specializers.get(instr.operation)
+        if specializer is not None:
+            instr.op = 0
+            try:
+                handler = specializer(self.arkhe, instr, end)
+            except ArkheException:
+                pass  # let the generic handler raise it at runtime
+
+        self.ends[pc] = end
+        return handler or self.generic(instr, end)
+
+    def fuse(self, pc):
+        """Returns a handler running the pair at pc, or the one at pc"""
+        handler = self.handlers[pc]
+        self.fault_ends[pc] = self.ends[pc]
+        first, end = self.arkhe.decode(pc)
+        if end >= len(self.arkhe.code):
+            return handler
+        try:
+            second, second_end = self.arkhe.decode(end)
+        except (ValueError, ArkheException):
+            return handler
+
+        fuser = self.fusers.get((first.operation, second.operation))
+        if fuser is None:
+            return handler
+        first.op = second.op = 0
+        try:
+            fused, self.fault_ends[pc] = fuser(self.arkhe, first, second, end, second_end)
+        except ArkheException:
+            return handler
+        return fused
+
+    def generic(self, instr, end):
+        dispatch = self.arkhe.machine.dispatch
+
+        def handler(vm):
+            vm.counter = end
+            instr.op = 0
+            dispatch(instr)
+            return vm.counter
+
+        return handler
+
+    def step(self):
+        vm = self.arkhe
+        pc = vm.counter
+        try:
+            vm.counter = self.handlers[pc](vm)
+        except BaseException:
+            vm.counter = self.ends.get(pc, pc)
+            raise
+
+    def run(self):
+        vm = self.arkhe
+        handlers = self.fused if self.fuse_pairs else self.handlers
+        ends = self.fault_ends if self.fuse_pairs else self.ends
+        budget = vm.budget
+        pc = vm.counter
+        eta = len(vm.code)
+        try:
+            if budget is None:
+                while pc < eta:
+                    pc = handlers[pc](vm)
+            else:
+                while pc < eta:
+                    chunk = budget.fuel + 1  # overdraws it
+                    try:
+                        for _ in repeat(None, chunk):
+                            pc = handlers[pc](vm)
+                    except Ended:
+                        break
+                    budget.spend(chunk)
+        except BudgetExceeded:
+            vm.counter = pc  # charged between handlers
+            raise
+        except BaseException:
+            vm.counter = ends.get(pc, pc)
+            raise
+        vm.counter = pc
+
+
+ENGINES = {"threaded": Threaded}
+
+
+@Threaded.specializer(Operation.LOAD)
+def load(vm, instr, end):
+    regs = vm.registers.data
+    target = instr.get_8()
+    value = load_const(instr, vm.consts)
+
+    def handler(vm):
+        regs[target] = value
+        return end
+
+    return handler
+
+
+@Threaded.specializer(Operation.ADD)
+@Threaded.specializer(Operation.SUB)
+@Threaded.specializer(Operation.MUL)
+@Threaded.specializer(Operation.TRUEDIV)
+def math(vm, instr, end):
+    regs = vm.registers.data
+    func = getattr(operator, instr.operation.name.lower())
+    operand1, operand2, target = instr.get_8(), instr.get_8(), instr.get_8()
+
+    def handler(vm):
+        regs[target] = func(regs[operand1], regs[operand2])
+        return end
+
+    return handler
+
+
+@Threaded.specializer(Operation.EQ)
+@Threaded.specializer(Operation.NE)
+@Threaded.specializer(Operation.LE)
+@Threaded.specializer(Operation.GE)
+@Threaded.specializer(Operation.GT)
+@Threaded.specializer(Operation.LT)
+def comparison(vm, instr, end):
+    regs = vm.registers.data
+    func = getattr(operator, instr.operation.name.lower())
+    operand1, operand2 = instr.get_8(), instr.get_8()
+
+    def handler(vm):
+        vm._eqflag = func(regs[operand1], regs[operand2])
+        return end
+
+    return handler
+
+
+@Threaded.specializer(Operation.JMP)
+def jmp(vm, instr, end):
+    regs = vm.registers.data
+    register = instr.get_8()
+
+    def handler(vm):
+        return regs[register]
+
+    return handler
+
+
+@Threaded.specializer(Operation.JMPF)
+def jmp_forward(vm, instr, end):
+    regs = vm.registers.data
+    register = instr.get_8()
+
+    def handler(vm):
+        return end + regs[register]
+
+    return handler
+
+
+@Threaded.specializer(Operation.JMPB)
+def jmp_backward(vm, instr, end):
+    regs = vm.registers.data
+    register = instr.get_8()
+
+    def handler(vm):
+        return end - regs[register]
+
+    return handler
+
+
+@Threaded.specializer(Operation.JEQ)
+def jmp_ifeq(vm, instr, end):
+    regs = vm.registers.data
+    register = instr.get_8()
+
+    def handler(vm):
+        value = regs[register]
+        return value if vm._eqflag else end
+
+    return handler
+
+
+@Threaded.specializer(Operation.JNE)
+def jmp_ifne(vm, instr, end):
+    regs = vm.registers.data
+    register = instr.get_8()
+
+    def handler(vm):
+        value = regs[register]
+        return end if vm._eqflag else value
+
+    return handler
+
+
+@Threaded.specializer(Operation.JFE)
+def jmpf_ifeq(vm, instr, end):
+    regs = vm.registers.data
+    register = instr.get_8()
+
+    def handler(vm):
+        value = regs[register]
+        return end + value if vm._eqflag else end
+
+    return handler
+
+
+@Threaded.specializer(Operation.JFN)
+def jmpf_ifne(vm, instr, end):
+    regs = vm.registers.data
+    register = instr.get_8()
+
+    def handler(vm):
+        value = regs[register]
+        return end if vm._eqflag else end + value
+
+    return handler
+
+
+@Threaded.specializer(Operation.INSERT)
+def mem_insert(vm, instr, end):
+    regs = vm.registers.data
+    position, value = instr.get_8(), instr.get_8()
+
+    def handler(vm):
+        try:
+            vm.memory[regs[position]] = regs[value]
+        except IndexError:
+            raise MemoryFault("Insert operation to not owned area!")
+        return end
+
+    return handler
+
+
+@Threaded.specializer(Operation.READ)
+def mem_read(vm, instr, end):
+    regs = vm.registers.data
+    position, target = instr.get_8(), instr.get_8()
+
+    def handler(vm):
+        try:
+            regs[target] = vm.memory[regs[position]]
+        except IndexError:
+            raise MemoryFault("Read operation to not owned area!")
+        return end
+
+    return handler
+
+
+@Threaded.specializer(Operation.SYMSET)
+def sym_set(vm, instr, end):
+    regs = vm.registers.data
+    name, value = instr.get_8(), instr.get_8()
+    key = table = values = slot = None  # inline cache
+
+    def handler(vm):
+        nonlocal key, table, values, slot
+        current = regs[name]
+        if current is not key or vm.symtable is not table:
+            key, table = current, vm.symtable
+            values, slot = table.values, table.slot(current)
+        if values[slot] is UNSET:
+            table.store(slot, regs[value])
+        else:
+            values[slot] = regs[value]
+        return end
+
+    return handler
+
+
+@Threaded.specializer(Operation.SYMREAD)
+def sym_read(vm, instr, end):
+    regs = vm.registers.data
+    name, target = instr.get_8(), instr.get_8()
+    key = table = values = slot = None  # inline cache
+
+    def handler(vm):
+        nonlocal key, table, values, slot
+        current = regs[name]
+        if current is not key or vm.symtable is not table:
+            key, table = current, vm.symtable
+            values, slot = table.values, table.slot(current)
+        value = values[slot]
+        if value is UNSET:
+            raise UnknownSymbol(f"{current}")
+        regs[target] = value
+        return end
+
+    return handler
+
+
+@Threaded.specializer(Operation.CCALL)
+def ccall(vm, instr, end):
+    regs = vm.registers.data
+    name, target = instr.get_8(), instr.get_8()
+    arguments = instr.operands[1:-1]
+
+    def handler(vm):
+        args = [regs[n] for n in arguments]
+        regs[target] = vm.bindings.call(regs[name], args, vm.memory)
+        return end
+
+    return handler
+
+
+@Threaded.specializer(Operation.NOP)
+def nop(vm, instr, end):
+    def handler(vm):
+        return end
+
+    return handler
+
+
+@Threaded.specializer(Operation.HLT)
+def hlt(vm, instr, end):
+    def handler(vm):
+        raise HLT()
+
+    return handler
+
+
+@Threaded.fuser(COMPARISON_OPS, CONDITIONAL_JUMPS)
+def compare_jump(vm, compare, jump, end, second_end):
+    regs = vm.registers.data
+    func = getattr(operator, compare.operation.name.lower())
+    operand1, operand2 = compare.get_8(), compare.get_8()
+    register = jump.get_8()
+    relative, on_flag = CONDITIONAL_JUMPS[jump.operation]
+
+    if relative and on_flag:
+
+        def handler(vm):
+            flag = vm._eqflag = func(regs[operand1], regs[operand2])
+            if flag:
+                return second_end + regs[register]
+            return second_end
+
+    elif relative:
+
+        def handler(vm):
+            flag = vm._eqflag = func(regs[operand1], regs[operand2])
+            if flag:
+                return second_end
+            return second_end + regs[register]
+
+    elif on_flag:
+
+        def handler(vm):
+            flag = vm._eqflag = func(regs[operand1], regs[operand2])
+            if flag:
+                return regs[register]
+            return second_end
+
+    else:
+
+        def handler(vm):
+            flag = vm._eqflag = func(regs[operand1], regs[operand2])
+            if flag:
+                return second_end
+            return regs[register]
+
+    return handler, end  # only the comparison can fault
+
+
+@Threaded.fuser([Operation.LOAD], MATH_OPS)
+def load_math(vm, load, math, end, second_end):
+    regs = vm.registers.data
+    target = load.get_8()
+    value = load_const(load, vm.consts)
+    func = getattr(operator, math.operation.name.lower())
+    operand1, operand2, result = math.get_8(), math.get_8(), math.get_8()
+
+    if operand2 == target and operand1 != target:
+
+        def handler(vm):
+            regs[target] = value
+            regs[result] = func(regs[operand1], value)
+            return second_end
+
+    else:
+
+        def handler(vm):
+            regs[target] = value
+            regs[result] = func(regs[operand1], regs[operand2])
+            return second_end
+
+    return handler, second_end  # only the math can fault
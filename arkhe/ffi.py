@@ -0,0 +1,98 @@
+"""
+Foreign function bindings for CCALL.
+
+`Bindings` resolves symbols from its libraries (libc first, see
+`load_library` for others) and keeps the resolved functions in a bounded
+LRU cache keyed by name. `declare` gives a symbol `argtypes`/`restype` so
+ctypes converts the arguments in C; a `MEMORY` argument is a VM memory index
+that is passed as a pointer to that cell. `calls` counts the calls per
+symbol.
+"""
+import ctypes
+import threading
+from collections import Counter, OrderedDict
+
+from arkhe.vm import MemoryFault, UnknownSymbol, libc
+
+MAX_BINDINGS = 128
+MEMORY = object()  # argtype of VM memory indexes passed as pointers
+
+
+class Binding:
+    __slots__ = ("function", "pointers")
+
+    def __init__(self, function, pointers=()):
+        self.function = function
+        self.pointers = pointers
+
+
+class Bindings:
+    def __init__(self, libraries=(), max_size=MAX_BINDINGS):
+        self.libraries = [libc]
+        self.max_size = max_size
+        self.signatures = {}
+        self.calls = Counter()
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()  # calls may come from executor threads
+        for library in libraries:
+            self.load_library(library)
+
+    def load_library(self, library):
+        """Adds a library (a path or a loaded ctypes library) to search"""
+        if not isinstance(library, ctypes.CDLL):
+            library = ctypes.CDLL(library)
+        self.libraries.append(library)
+        self._cache.clear()
+        return library
+
+    def declare(self, name, argtypes=None, restype=ctypes.c_int):
+        self.signatures[name] = argtypes, restype
+        self._cache.pop(name, None)
+
+    def resolve(self, name):
+        binding = self._cache.get(name)
+        if binding is not None:
+            self._cache.move_to_end(name)
+            return binding
+
+        binding = self._cache[name] = self._bind(name)
+        if len(self._cache) > self.max_size:
+            self._cache.popitem(last=False)
+        return binding
+
+    def _bind(self, name):
+        for library in self.libraries:
+            try:
+                function = library[name]  # a new object, unlike getattr
+                break
+            except (AttributeError, TypeError):
+                continue
+        else:
+            raise UnknownSymbol(f"{name}")
+
+        pointers = ()
+        if name in self.signatures:
+            argtypes, function.restype = self.signatures[name]
+            if argtypes is not None:
+                pointers = tuple(
+                    n for n, argtype in enumerate(argtypes) if argtype is MEMORY
+                )
+                function.argtypes = [
+                    ctypes.c_void_p if argtype is MEMORY else argtype
+                    for argtype in argtypes
+                ]
+        return Binding(function, pointers)
+
+    def call(self, name, args, memory=None):
+        with self._lock:
+            binding = self.resolve(name)
+            self.calls[name] += 1
+        args = [bytes(arg, "utf8") if isinstance(arg, str) else arg for arg in args]
+        for position in binding.pointers:
+            try:
+                args[position] = memory.address(args[position])
+            except IndexError:
+                raise MemoryFault("Pointer to not owned area!")
+            except AttributeError:
+                raise MemoryFault(f"{type(memory).__name__} can't be passed to C!")
+        return binding.function(*args)
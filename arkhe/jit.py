@@ -0,0 +1,281 @@
+"""
+Tracing JIT for hot loops.
+
+While evaluating, the tracer counts how often every backward JMP/JMPB target
+is hit. Once a target gets hot, the next iteration is recorded instruction by
+instruction and translated into a Python function with `compile()`. Branches
+taken while recording become guards; when a guard fails the function leaves
+through a side exit that writes back `counter` and `_eqflag` (registers and
+memory are always updated in place) and the interpreter takes over.
+
+Under an eval() budget the interpreter charges every backward jump, and
+traces run a metered copy that charges its length per iteration.
+"""
+from itertools import count
+
+from arkhe.vm import (
+    UNSET,
+    ArkheException,
+    Instr,
+    MemoryFault,
+    Operation,
+    UnknownSymbol,
+    load_const,
+)
+
+HOT_LOOP = 50
+MAX_TRACE = 256
+METERED_CHUNK = 256  # iterations between budget checks in a trace (small ints)
+
+BACKWARD_JUMPS = frozenset({Operation.JMP, Operation.JMPB})
+MATH = {
+    Operation.ADD: "+",
+    Operation.SUB: "-",
+    Operation.MUL: "*",
+    Operation.TRUEDIV: "/",
+}
+CONDITIONAL_JUMPS = {  # operation: (relative, jumps on flag)
+    Operation.JEQ: (False, True),
+    Operation.JNE: (False, False),
+    Operation.JFE: (True, True),
+    Operation.JFN: (True, False),
+}
+COMPARISONS = {
+    Operation.EQ: "==",
+    Operation.NE: "!=",
+    Operation.LT: "<",
+    Operation.GT: ">",
+    Operation.LE: "<=",
+    Operation.GE: ">=",
+}
+
+
+class Tracer:
+    def __init__(self, arkhe, threshold=HOT_LOOP, limit=MAX_TRACE):
+        self.arkhe = arkhe
+        self.threshold = threshold
+        self.limit = limit
+        self.compiled = 0
+        self.entered = 0
+        self.reset()
+
+    def reset(self):
+        self.hits = {}
+        self.steps = {}  # target: recorded steps of its trace
+        self.traces = {}
+        self.metered = {}  # the traces charging the budget
+        self.blacklist = set()
+
+    def run(self):
+        vm = self.arkhe
+        budget = vm.budget
+        eta = len(vm.code)
+        while vm.counter < eta:
+            pc = vm.counter
+            instr = vm.next_instr()
+            vm.machine.dispatch(instr)
+            if vm.counter <= pc:
+                if budget is not None:
+                    budget.charge(vm.counter, pc)
+                if instr.operation in BACKWARD_JUMPS:
+                    self.hit(vm.counter, eta)
+
+    def hit(self, target, eta):
+        metered = self.arkhe.budget is not None
+        traces = self.metered if metered else self.traces
+        trace = traces.get(target)
+        if trace is None and target in self.steps:
+            trace = traces[target] = self.translate(target, self.steps[target], metered)
+        if trace is not None:
+            self.entered += 1
+            return trace(self.arkhe)
+
+        if target in self.blacklist:
+            return
+
+        hits = self.hits[target] = self.hits.get(target, 0) + 1
+        if hits >= self.threshold:
+            del self.hits[target]
+            self.record(target, eta)
+
+    def record(self, target, eta):
+        vm = self.arkhe
+        steps = []
+        while len(steps) < self.limit:
+            flag = vm._eqflag
+            instr = vm.next_instr()
+            end = vm.counter
+            vm.machine.dispatch(instr)
+            steps.append((instr, end, vm.counter, flag))
+            if vm.counter == target:
+                self.steps[target] = steps
+                self.compiled += 1
+                if vm.budget is not None:
+                    vm.budget.spend(len(steps))
+                return
+            if not 0 <= vm.counter < eta:
+                break
+
+        self.blacklist.add(target)
+
+    def translate(self, target, steps, metered=False):
+        namespace = {
+            "MemoryFault": MemoryFault,
+            "UnknownSymbol": UnknownSymbol,
+            "UNSET": UNSET,
+            "METERED_CHUNK": METERED_CHUNK,
+        }
+        names = (f"k{n}" for n in count())
+
+        def bind(value):
+            name = next(names)
+            namespace[name] = value
+            return name
+
+        body = []
+        for instr, end, next_, flag in steps:
+            try:
+                code = self.translate_step(
+                    instr.operation, instr.operands, end, next_, flag, bind
+                )
+            except (ArkheException, IndexError, ValueError):
+                code = None  # malformed operands, let the VM raise it
+
+            if code is None:
+                name = bind(instr)  # the decoded one, its operand cursor is reset
+                code = [
+                    f"vm.counter = {end}",
+                    "vm._eqflag = flag",
+                    f"{name}.op = 0",
+                    f"dispatch({name})",
+                    "flag = vm._eqflag",
+                    *guard(f"vm.counter != {next_}", "vm.counter"),
+                ]
+            body.append(f"pc = {end}")
+            body.extend(code)
+        size = len(steps)
+        loop = ["while True:", *(f"    {line}" for line in body)]
+        if metered:
+            loop = [
+                "while True:",
+                f"    paid = min(budget.fuel // {size}, METERED_CHUNK)",
+                "    for left in range(paid, -1, -1):  # the last one overdraws it",
+                *(f"        {line}" for line in body),
+                f"    budget.fuel -= (paid + 1) * {size}",
+                "    paid = left = 0",
+                f"    pc = {target}",
+                "    budget.refill()",
+            ]
+
+        source = "\n".join(
+            [
+                "def trace(vm):",
+                "    regs = vm.registers.data",
+                "    memory = vm.memory",
+                "    symtable = vm.symtable",
+                "    dispatch = vm.machine.dispatch",
+                "    flag = vm._eqflag",
+                *(["    budget = vm.budget", "    paid = left = 0"] if metered else []),
+                f"    pc = {target}",
+                "    try:",
+                *(f"        {line}" for line in loop),
+                "    except BaseException:",
+                "        vm.counter = pc",
+                "        vm._eqflag = flag",
+                "        raise",
+                *(
+                    [
+                        "    finally:  # charges the iterations run in this chunk",
+                        f"        budget.fuel -= (paid - left) * {size}",
+                    ]
+                    if metered
+                    else []
+                ),
+            ]
+        )
+        exec(compile(source, f"<arkhe trace at {target}>", "exec"), namespace)
+        return namespace["trace"]
+
+    def translate_step(self, operation, operands, end, next_, flag, bind):
+        """Returns the lines for a recorded step, or None for the VM's handler"""
+        if operation is Operation.LOAD:
+            instr = Instr(operation, operands)
+            target = instr.get_8()
+            return [f"regs[{target}] = {bind(load_const(instr, self.arkhe.consts))}"]
+        elif operation in MATH:
+            operand1, operand2, target = operands[:3]
+            return [f"regs[{target}] = regs[{operand1}] {MATH[operation]} regs[{operand2}]"]
+        elif operation in COMPARISONS:
+            operand1, operand2 = operands[:2]
+            return [f"flag = regs[{operand1}] {COMPARISONS[operation]} regs[{operand2}]"]
+        elif operation is Operation.JMP:
+            return [f"t = regs[{operands[0]}]", *guard(f"t != {next_}", "t")]
+        elif operation is Operation.JMPF:
+            return [f"t = {end} + regs[{operands[0]}]", *guard(f"t != {next_}", "t")]
+        elif operation is Operation.JMPB:
+            return [f"t = {end} - regs[{operands[0]}]", *guard(f"t != {next_}", "t")]
+        elif operation in CONDITIONAL_JUMPS:
+            relative, on_flag = CONDITIONAL_JUMPS[operation]
+            taken = bool(flag) is on_flag
+            target = f"{end} + t" if relative else "t"
+            condition = "flag" if on_flag else "not flag"
+            code = [f"t = regs[{operands[0]}]"]
+            if taken:
+                code.extend(guard(f"not ({condition})", end))
+                code.extend(guard(f"{target} != {next_}", target))
+            else:
+                code.extend(guard(condition, target))
+            return code
+        elif operation is Operation.READ:
+            position, target = operands[:2]
+            return [
+                "try:",
+                f"    regs[{target}] = memory[regs[{position}]]",
+                "except IndexError:",
+                '    raise MemoryFault("Read operation to not owned area!")',
+            ]
+        elif operation is Operation.INSERT:
+            position, value = operands[:2]
+            return [
+                f"p, v = regs[{position}], regs[{value}]",
+                "try:",
+                "    memory[p] = v",
+                "except IndexError:",
+                '    raise MemoryFault("Insert operation to not owned area!")',
+            ]
+        elif operation is Operation.SYMSET:
+            name, value = operands[:2]
+            return [
+                *sym_slot(name, bind([None, None, None])),
+                f"symtable.store(slot, regs[{value}])",
+            ]
+        elif operation is Operation.SYMREAD:
+            name, target = operands[:2]
+            return [
+                *sym_slot(name, bind([None, None, None])),
+                "value = symtable.values[slot]",
+                "if value is UNSET:",
+                '    raise UnknownSymbol(f"{key}")',
+                f"regs[{target}] = value",
+            ]
+        elif operation is Operation.NOP:
+            return []
+
+
+def sym_slot(name, cache):
+    """Lines that set `slot` through the inline cache [key, symtable, slot]"""
+    return [
+        f"key = regs[{name}]",
+        f"if key is not {cache}[0] or symtable is not {cache}[1]:",
+        f"    {cache}[:] = key, symtable, symtable.slot(key)",
+        f"slot = {cache}[2]",
+    ]
+
+
+def guard(condition, counter):
+    return [
+        f"if {condition}:",
+        f"    vm.counter = {counter}",
+        "    vm._eqflag = flag",
+        "    return",
+    ]
@@ -0,0 +1,93 @@
+"""
+On-disk cache of assembled programs, similar to __pycache__.
+
+Entries are .arkc files named after the hash of the source, the Arkhe
+version and the grammar, so a warm start skips Lark entirely. When the cache grows past its
+size limit the least recently used entries are removed. Set ARKHE_NO_CACHE
+to disable it, ARKHE_CACHE_DIR to move it.
+"""
+import hashlib
+import os
+from pathlib import Path
+
+from arkhe import __version__, binary
+from arkhe.lang.parser import GRAMMAR
+
+DEFAULT_MAX_SIZE = 64 * 1024 * 1024
+
+
+def cache_disabled():
+    return bool(os.environ.get("ARKHE_NO_CACHE"))
+
+
+def default_directory():
+    if "ARKHE_CACHE_DIR" in os.environ:
+        return Path(os.environ["ARKHE_CACHE_DIR"])
+    base = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(base) / "arkhe"
+
+
+class CompileCache:
+    def __init__(self, directory=None, max_size=DEFAULT_MAX_SIZE):
+        self.directory = Path(directory or default_directory())
+        self.max_size = max_size
+
+    def key(self, source):
+        digest = hashlib.sha256(f"{__version__}\0{GRAMMAR}\0{source}".encode("utf8"))
+        return digest.hexdigest()
+
+    def path(self, source):
+        return self.directory / f"{self.key(source)}.arkc"
+
+    def get(self, source):
+        path = self.path(source)
+        try:
+            with open(path, "rb") as f:
+                code = list(binary.load(f).code)
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        except (OSError, binary.InvalidProgram):
+            self.discard(path)
+            return None
+        return code
+
+    def put(self, source, code):
+        path = self.path(source)
+        temp = path.with_suffix(f".{os.getpid()}.tmp")
+        try:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            with open(temp, "wb") as f:
+                binary.dump(code, f)
+            os.replace(temp, path)
+        except (OSError, binary.InvalidProgram):
+            self.discard(temp)
+            return
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for path in self.directory.glob("*.arkc"):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            self.discard(path)
+            total -= size
+
+    def clear(self):
+        for path in self.directory.glob("*.arkc"):
+            self.discard(path)
+
+    @staticmethod
+    def discard(path):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
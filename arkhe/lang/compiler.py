@@ -1,14 +1,17 @@
 from functools import partial
-from itertools import chain
+from itertools import chain, islice
 
 from lark import Transformer
-from lark.exceptions import ParseError
+from lark.exceptions import ParseError, UnexpectedInput
 
+from arkhe.lang.cache import CompileCache, cache_disabled
 from arkhe.lang.parser import get_parser
+from arkhe.optimizer import optimize
 from arkhe.utils import create_instr
 from arkhe.vm import Operation
 
 b16 = partial(int, base=16)
+STREAM_LINES = 4096
 
 
 class InvalidInstrSize(Exception):
@@ -26,13 +29,66 @@ class Base10(Transformer):
         return create_instr(op, *operands)
 
 
+class Instructions(Base10):
+    def start(self, instrs):
+        return instrs
+
+
 class Parser:
-    def __init__(self):
-        self.parser = get_parser()
-        self.transformer = Base10()
+    def __init__(self, cache=True, optimize=False):
+        """cache can be False, True (the default cache) or a CompileCache
+
+        With optimize, parsed code goes through arkhe.optimizer and `saved`
+        holds the number of words it saved on the last call.
+        """
+        self._parser = None
+        self.optimize = optimize
+        self.saved = 0
+        if cache is True:
+            cache = None if cache_disabled() else CompileCache()
+        self.cache = cache or None
+
+    @property
+    def parser(self):
+        if self._parser is None:
+            self._parser = get_parser(Base10)
+        return self._parser
 
     def __call__(self, code):
-        return self.transformer.transform(self.parser.parse(code))
+        result = self.cache.get(code) if self.cache is not None else None
+        if result is None:
+            result = self.parser.parse(code)
+            if self.cache is not None:
+                self.cache.put(code, result)
+
+        if self.optimize:
+            optimized = optimize(result)
+            self.saved = optimized.saved
+            return optimized.code
+        return result
+
+    def stream(self, file, lines=STREAM_LINES):
+        """Yields the code words of each instruction in file, one by one
+
+        The source is parsed in chunks of lines so memory use stays flat no
+        matter how big it is. The compile cache isn't used.
+        """
+        parser = get_parser(Instructions)
+        base = 0
+        while True:
+            chunk = list(islice(file, lines))
+            if not chunk:
+                break
+
+            text = "".join(chunk)
+            if text.strip():
+                try:
+                    yield from parser.parse(text)
+                except UnexpectedInput as exc:
+                    if exc.line > 0:
+                        exc.line += base
+                    raise
+            base += len(chunk)
 
 
 if __name__ == "__main__":
@@ -41,7 +97,7 @@ if __name__ == "__main__":
     code = """
     LOAD 00 01 F4
     LOAD 01 03 E8
-    ADD 00 01 02 
+    ADD 00 01 02
     """
     tree = parser.parse(code)
     print(transformer.transform(tree))
@@ -1,4 +1,5 @@
 import textwrap
+from functools import lru_cache
 
 # from pathlib import Path
 from lark import Lark
@@ -6,21 +7,30 @@ from lark import Lark
 # GRAMMAR = Path(__file__).parent / "grammar.lark"
 GRAMMAR = textwrap.dedent(
     """
-start: instr+
+start: _NL* instr (_NL+ instr)* _NL*
 instr: OP OPERAND+
 
 OPERAND: HEXDIGIT~2..4
+_NL: /\\r?\\n/
 
 %import common.HEXDIGIT
 %import common.CNAME -> OP
-%import common.WS
-%ignore WS
+%import common.WS_INLINE
+%ignore WS_INLINE
 """
 )
 
 
-def get_parser():
+@lru_cache()
+def get_parser(transformer=None):
+    """Builds the LALR parser once, transformer (a class) is applied inline
+
+    Instructions are newline terminated, so the contextual lexer can tell
+    an operation (e.g ADD) from a hex operand that looks like one.
+    """
     # with open(GRAMMAR) as f:
     #    grammar = f.read()
 
-    return Lark(GRAMMAR)
+    if transformer is not None:
+        transformer = transformer()
+    return Lark(GRAMMAR, parser="lalr", transformer=transformer)
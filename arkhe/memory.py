@@ -0,0 +1,791 @@
+"""
+VM memory backends.
+
+`Memory` keeps cells in a growable typed buffer (`array('q')` by default)
+plus a head offset, so deallocating from the head is O(1) amortized and
+allocation is a bulk extend. Storing something that doesn't fit into the
+buffer (strings, floats, bigger ints...) moves the cells into a plain list.
+Out of range accesses raise IndexError like lists do, the VM turns them into
+MemoryFault.
+
+Every backend also has the bulk operations behind MEMCPY/MEMSET/MEMSUM/MEMCMP
+(`copy`, `fill`, `sum` and `compare` over count cells). They work on buffer
+slices (NumPy operations for `NumpyMemory`) instead of cell by cell, and
+check the whole range up front so a fault leaves the memory untouched.
+`read` and `write` move a range at once, e.g for vector registers.
+
+`cas`, `fetch_add`, `fence` and `barrier` back the atomic opcodes. A VM runs
+one instruction at a time, so for single process backends they are plain
+read-modify-writes; `SharedMemory` locks the cell so they also hold between
+processes.
+"""
+import mmap
+import os
+import tempfile
+import threading
+import time
+from array import array
+from contextlib import contextmanager
+
+from arkhe.vm import MemoryFault
+
+CELL = "q"
+CELL_SIZE = array(CELL).itemsize
+MAX_CELL = 2 ** (8 * CELL_SIZE - 1) - 1
+MIN_CAPACITY = 16
+
+
+def check_span(size, start, count):
+    if count < 0 or start < 0 or start + count > size:
+        raise IndexError("memory range out of range")
+
+
+class Atomics:
+    """Atomic operations for memory only one VM uses at a time"""
+
+    def cas(self, index, expected, value):
+        """Stores value at index if it holds expected, returns the old value"""
+        old = self[index]
+        if old == expected:
+            self[index] = value
+        return old
+
+    def fetch_add(self, index, value):
+        """Adds value to the cell at index, returns the old value"""
+        old = self[index]
+        self[index] = old + value
+        return old
+
+    def fence(self):
+        pass
+
+    def barrier(self, index, parties):
+        """Counts an arrival on the cell at index; the last of parties
+        arrivals resets it and bumps the generation at index + 1
+
+        The caller is the only party here, so it can't wait for others.
+        """
+        check_span(len(self), index, 2)
+        if self[index] + 1 < parties:
+            raise MemoryFault("Barrier would wait forever, it needs shared memory!")
+        self[index] = 0
+        self[index + 1] += 1
+
+
+class Memory(Atomics):
+    def __init__(self, store="array"):
+        self.store = store
+        self._buffer = self._new()
+        self._head = 0
+        self._size = 0
+
+    def _new(self):
+        if self.store == "array":
+            return array(CELL)
+        elif self.store == "list":
+            return []
+        raise ValueError(f"Unknown memory store {self.store!r}")
+
+    def alloc(self, amount):
+        if amount <= 0:
+            return
+        if self.store == "array":
+            self._buffer.frombytes(bytes(CELL_SIZE * amount))
+        else:
+            self._buffer.extend([0] * amount)
+        self._size += amount
+
+    def dealloc(self, amount, head):
+        if amount > self._size:
+            raise MemoryFault("Deallocation of not owned area!")
+        if amount <= 0:
+            return
+
+        self._size -= amount
+        if not self._size:
+            self._buffer, self._head = self._new(), 0
+        elif head:
+            self._head += amount
+            if self._head > self._size:
+                self._compact()
+        else:
+            del self._buffer[self._head + self._size :]
+
+    def _compact(self):
+        del self._buffer[: self._head]
+        self._head = 0
+
+    def _promote(self):
+        """Moves the cells to a list so they can hold any value"""
+        self._buffer = list(self)
+        self._head = 0
+        self.store = "list"
+
+    def _index(self, index):
+        if index < 0:
+            index += self._size
+        if 0 <= index < self._size:
+            return self._head + index
+        raise IndexError("memory index out of range")
+
+    def __getitem__(self, index):
+        return self._buffer[self._index(index)]
+
+    def _span(self, start, count):
+        """Returns the buffer slice of count cells from start"""
+        check_span(self._size, start, count)
+        start += self._head
+        return slice(start, start + count)
+
+    def copy(self, target, source, count):
+        """Copies count cells from source to target, they may overlap"""
+        target, source = self._span(target, count), self._span(source, count)
+        self._buffer[target] = self._buffer[source]
+
+    def fill(self, start, value, count):
+        cells = self._span(start, count)
+        if not count:
+            return
+        if self.store == "array" and type(value) is int:
+            try:
+                self._buffer[cells] = array(CELL, [value]) * count
+                return
+            except OverflowError:
+                pass
+        if self.store != "list":
+            self._promote()
+            cells = self._span(start, count)
+        self._buffer[cells] = [value] * count
+
+    def sum(self, start, count):
+        return sum(self._buffer[self._span(start, count)])
+
+    def compare(self, first, second, count):
+        """Returns whether the count cells from first and second are equal"""
+        first, second = self._span(first, count), self._span(second, count)
+        return self._buffer[first] == self._buffer[second]
+
+    def read(self, start, count):
+        """Returns the count cells from start as a buffer (a copy or a view)"""
+        return self._buffer[self._span(start, count)]
+
+    def write(self, start, values):
+        """Stores a sequence (anything with tolist, like arrays) from start"""
+        if hasattr(values, "tolist"):
+            values = values.tolist()
+        cells = self._span(start, len(values))
+        if self.store == "array":
+            try:
+                self._buffer[cells] = array(CELL, values)
+                return
+            except (TypeError, OverflowError):
+                pass
+        if self.store != "list":
+            self._promote()
+            cells = self._span(start, len(values))
+        self._buffer[cells] = values
+
+    def __setitem__(self, index, value):
+        index = self._index(index)
+        if self.store == "list":
+            self._buffer[index] = value
+            return
+
+        if type(value) is int:
+            try:
+                self._buffer[index] = value
+                return
+            except OverflowError:
+                pass
+
+        index -= self._head
+        self._promote()
+        self._buffer[index] = value
+
+    @property
+    def resident(self):
+        return self._size
+
+    def address(self, index):
+        """Returns the address of the cell at index, e.g for CCALL pointers
+
+        It is only valid until the next ALLOC/DEALLOC.
+        """
+        if self.store != "array":
+            raise MemoryFault("Only typed memory can be passed to C!")
+        return self._buffer.buffer_info()[0] + self._index(index) * CELL_SIZE
+
+    def __len__(self):
+        return self._size
+
+    def __iter__(self):
+        buffer, start = self._buffer, self._head
+        for index in range(start, start + self._size):
+            yield buffer[index]
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.store}, size={self._size})"
+
+
+class NumpyMemory(Memory):
+    """Memory over a NumPy int64 buffer that grows by doubling"""
+
+    def __init__(self):
+        import numpy
+
+        self.numpy = numpy
+        super().__init__(store="numpy")
+
+    def _new(self):
+        if self.store == "numpy":
+            return self.numpy.zeros(MIN_CAPACITY, dtype=self.numpy.int64)
+        return super()._new()
+
+    def alloc(self, amount):
+        if self.store != "numpy":
+            return super().alloc(amount)
+        if amount <= 0:
+            return
+
+        end = self._head + self._size
+        if end + amount > len(self._buffer):
+            self._compact()
+            end = self._size
+            capacity = max(2 * len(self._buffer), end + amount)
+            if capacity > len(self._buffer):
+                buffer = self.numpy.zeros(capacity, dtype=self.numpy.int64)
+                buffer[:end] = self._buffer[:end]
+                self._buffer = buffer
+        self._buffer[end : end + amount] = 0
+        self._size += amount
+
+    def dealloc(self, amount, head):
+        if self.store != "numpy":
+            return super().dealloc(amount, head)
+        if amount > self._size:
+            raise MemoryFault("Deallocation of not owned area!")
+        if amount <= 0:
+            return
+
+        self._size -= amount
+        if head:
+            self._head += amount
+        if not self._size:
+            self._head = 0
+
+    def _compact(self):
+        if self.store != "numpy":
+            return super()._compact()
+        size = self._size
+        self._buffer[:size] = self._buffer[self._head : self._head + size]
+        self._head = 0
+
+    def _promote(self):
+        self._buffer = self._buffer[self._head : self._head + self._size].tolist()
+        self._head = 0
+        self.store = "list"
+
+    def __getitem__(self, index):
+        value = self._buffer[self._index(index)]
+        return value if self.store == "list" else int(value)
+
+    def __setitem__(self, index, value):
+        if self.store != "numpy":
+            return super().__setitem__(index, value)
+
+        index = self._index(index)
+        if type(value) is int:
+            try:
+                self._buffer[index] = value
+                return
+            except OverflowError:
+                pass
+
+        index -= self._head
+        self._promote()
+        self._buffer[index] = value
+
+    def fill(self, start, value, count):
+        if self.store == "numpy" and type(value) is int:
+            cells = self._span(start, count)
+            try:
+                self._buffer[cells] = value
+                return
+            except OverflowError:
+                pass
+        super().fill(start, value, count)
+
+    def sum(self, start, count):
+        if self.store != "numpy":
+            return super().sum(start, count)
+        cells = self._buffer[self._span(start, count)]
+        if not count:
+            return 0
+        bound = max(-int(cells.min()), int(cells.max()))
+        if bound * count <= MAX_CELL:
+            return int(cells.sum())
+        return sum(cells.tolist())  # int64 sum could wrap around
+
+    def compare(self, first, second, count):
+        if self.store != "numpy":
+            return super().compare(first, second, count)
+        first, second = self._span(first, count), self._span(second, count)
+        return bool(self.numpy.array_equal(self._buffer[first], self._buffer[second]))
+
+    def write(self, start, values):
+        if self.store == "numpy":
+            values = self.numpy.asarray(values)
+            cells = self._span(start, len(values))
+            if values.dtype.kind == "b" or self.numpy.can_cast(
+                values.dtype, self.numpy.int64
+            ):
+                self._buffer[cells] = values
+                return
+        super().write(start, values)
+
+    def address(self, index):
+        if self.store != "numpy":
+            return super().address(index)
+        return self._buffer.ctypes.data + self._index(index) * CELL_SIZE
+
+    def __iter__(self):
+        if self.store == "list":
+            return super().__iter__()
+        return iter(self._buffer[self._head : self._head + self._size].tolist())
+
+
+class PagedMemory(Atomics):
+    """Sparse memory made of fixed size pages created on first write
+
+    Allocating only grows the logical size, untouched cells read as 0 and
+    deallocation drops whole pages. max_pages caps the resident pages.
+    """
+
+    def __init__(self, page_size=4096, max_pages=None):
+        self.page_size = page_size
+        self.max_pages = max_pages
+        self.pages = {}
+        self._head = 0
+        self._size = 0
+
+    @property
+    def resident(self):
+        return len(self.pages) * self.page_size
+
+    def alloc(self, amount):
+        if amount > 0:
+            self._size += amount
+
+    def dealloc(self, amount, head):
+        if amount > self._size:
+            raise MemoryFault("Deallocation of not owned area!")
+        if amount <= 0:
+            return
+
+        self._size -= amount
+        if not self._size:
+            self.pages.clear()
+            self._head = 0
+        elif head:
+            self._head += amount
+            first = self._head // self.page_size
+            for page in [page for page in self.pages if page < first]:
+                del self.pages[page]
+        else:
+            last, offset = divmod(self._head + self._size, self.page_size)
+            for page in [page for page in self.pages if page > last]:
+                del self.pages[page]
+            if last in self.pages:
+                if offset:
+                    self.pages[last][offset:] = self._page()[offset:]
+                else:
+                    del self.pages[last]
+
+    def _page(self):
+        return array(CELL, bytes(CELL_SIZE * self.page_size))
+
+    def _address(self, index):
+        if index < 0:
+            index += self._size
+        if 0 <= index < self._size:
+            return divmod(self._head + index, self.page_size)
+        raise IndexError("memory index out of range")
+
+    def __getitem__(self, index):
+        page, offset = self._address(index)
+        try:
+            return self.pages[page][offset]
+        except KeyError:
+            return 0
+
+    def __setitem__(self, index, value):
+        page, offset = self._address(index)
+        cells = self.pages.get(page)
+        if cells is None:
+            if type(value) is int and value == 0:
+                return
+            if self.max_pages is not None and len(self.pages) >= self.max_pages:
+                raise MemoryFault("Resident page limit reached!")
+            cells = self.pages[page] = self._page()
+
+        if type(value) is int and type(cells) is array:
+            try:
+                cells[offset] = value
+                return
+            except OverflowError:
+                pass
+
+        if type(cells) is array:
+            cells = self.pages[page] = cells.tolist()
+        cells[offset] = value
+
+    def _chunks(self, start, count):
+        """Yields (page, offset, length) for the pieces of count cells from
+        start, checking the range first"""
+        check_span(self._size, start, count)
+        position = self._head + start
+        end = position + count
+        while position < end:
+            page, offset = divmod(position, self.page_size)
+            length = min(self.page_size - offset, end - position)
+            yield page, offset, length
+            position += length
+
+    def _store(self, pieces):
+        """Stores (page, offset, cells) pieces, creating their pages
+
+        The page limit is checked for all of them before anything changes.
+        """
+        new = {page for page, _, _ in pieces if page not in self.pages}
+        if self.max_pages is not None and len(self.pages) + len(new) > self.max_pages:
+            raise MemoryFault("Resident page limit reached!")
+        for page, offset, cells in pieces:
+            target = self.pages.get(page)
+            if target is None:
+                target = self.pages[page] = self._page()
+            if type(target) is array and type(cells) is not array:
+                target = self.pages[page] = target.tolist()
+            target[offset : offset + len(cells)] = cells
+
+    def copy(self, target, source, count):
+        self.write(target, self.read(source, count))
+
+    def fill(self, start, value, count):
+        try:
+            cell = array(CELL, [value]) if type(value) is int else [value]
+        except OverflowError:
+            cell = [value]
+        self._store(
+            [
+                (page, offset, cell * length)
+                for page, offset, length in self._chunks(start, count)
+                if page in self.pages or type(cell) is not array or cell[0]
+            ]
+        )
+
+    def sum(self, start, count):
+        total = 0
+        for page, offset, length in self._chunks(start, count):
+            cells = self.pages.get(page)
+            if cells is not None:  # absent pages are zeros
+                total += sum(cells[offset : offset + length])
+        return total
+
+    def compare(self, first, second, count):
+        first, second = self.read(first, count), self.read(second, count)
+        if type(first) is not type(second):
+            first, second = list(first), list(second)
+        return first == second
+
+    def read(self, start, count):
+        """Returns the count cells from start, an array unless some of them
+        are on a page holding other values"""
+        cells = array(CELL)
+        for page, offset, length in self._chunks(start, count):
+            piece = self.pages.get(page)
+            if piece is None:
+                piece = array(CELL, bytes(CELL_SIZE * length))
+            else:
+                piece = piece[offset : offset + length]
+            if type(piece) is not array and type(cells) is array:
+                cells = cells.tolist()
+            cells.extend(piece)
+        return cells
+
+    def write(self, start, values):
+        if hasattr(values, "tolist") and type(values) is not array:
+            values = values.tolist()
+        pieces, position = [], 0
+        for page, offset, length in self._chunks(start, len(values)):
+            piece = values[position : position + length]
+            position += length
+            try:
+                piece = array(CELL, piece)
+            except (TypeError, OverflowError):
+                piece = list(piece)
+            if page in self.pages or type(piece) is not array or any(piece):
+                pieces.append((page, offset, piece))
+        self._store(pieces)
+
+    def __len__(self):
+        return self._size
+
+    def __iter__(self):
+        for index in range(self._size):
+            yield self[index]
+
+    def __repr__(self):
+        return f"{type(self).__name__}(size={self._size}, resident={self.resident})"
+
+
+class MappedMemory(Atomics):
+    """Memory over a file of fixed width integer cells mapped with mmap
+
+    The file's existing cells are the initial memory, so data sets can be
+    handed to a program without copying and survive restarts. ALLOC/DEALLOC
+    grow and shrink the file, deallocating from the head moves the remaining
+    cells to the start. Call flush() to sync changes to disk. Resizing fails
+    with BufferError while views of `cells` are alive.
+    """
+
+    def __init__(self, path, cell=CELL):
+        self.path = path
+        self.cell = cell
+        self.cell_size = array(cell).itemsize
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        self._map = None
+        self.cells = memoryview(b"").cast(cell)
+        self._resize(os.fstat(self._fd).st_size // self.cell_size)
+
+    def _resize(self, size):
+        self.cells.release()
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+        os.ftruncate(self._fd, size * self.cell_size)
+        if size:
+            self._map = mmap.mmap(self._fd, size * self.cell_size)
+            self.cells = memoryview(self._map).cast(self.cell)
+        else:
+            self.cells = memoryview(b"").cast(self.cell)
+
+    @property
+    def resident(self):
+        return len(self.cells)
+
+    def alloc(self, amount):
+        if amount > 0:
+            self._resize(len(self.cells) + amount)
+
+    def dealloc(self, amount, head):
+        size = len(self.cells)
+        if amount > size:
+            raise MemoryFault("Deallocation of not owned area!")
+        if amount <= 0:
+            return
+
+        if head and amount < size:
+            start = amount * self.cell_size
+            self._map.move(0, start, size * self.cell_size - start)
+        self._resize(size - amount)
+
+    def flush(self):
+        if self._map is not None:
+            self._map.flush()
+
+    def close(self):
+        self.flush()
+        self.cells.release()
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        os.close(self._fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __getitem__(self, index):
+        return self.cells[index]
+
+    def __setitem__(self, index, value):
+        try:
+            self.cells[index] = value
+        except (TypeError, ValueError):
+            raise MemoryFault(f"Mapped memory can't hold {value!r}!")
+
+    def _span(self, start, count):
+        check_span(len(self.cells), start, count)
+        return slice(start, start + count)
+
+    def copy(self, target, source, count):
+        target, source = self._span(target, count), self._span(source, count)
+        self.cells[target] = self.cells[source]
+
+    def fill(self, start, value, count):
+        cells = self._span(start, count)
+        try:
+            self.cells[cells] = array(self.cell, [value]) * count
+        except (TypeError, OverflowError):
+            raise MemoryFault(f"Mapped memory can't hold {value!r}!")
+
+    def sum(self, start, count):
+        return sum(self.cells[self._span(start, count)])
+
+    def compare(self, first, second, count):
+        first, second = self._span(first, count), self._span(second, count)
+        return self.cells[first] == self.cells[second]
+
+    def read(self, start, count):
+        return self.cells[self._span(start, count)]
+
+    def write(self, start, values):
+        if hasattr(values, "tolist"):
+            values = values.tolist()
+        cells = self._span(start, len(values))
+        try:
+            self.cells[cells] = array(self.cell, values)
+        except (TypeError, OverflowError):
+            raise MemoryFault("Mapped memory can only hold ints!")
+
+    def __len__(self):
+        return len(self.cells)
+
+    def __iter__(self):
+        return iter(self.cells.tolist())
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.path!r}, size={len(self.cells)})"
+
+
+SPIN = 0.0001  # seconds between barrier generation checks
+BARRIER_TIMEOUT = 60.0
+_segments = {}  # name: [thread lock, lock file fd, handles] for this process
+_segments_lock = threading.Lock()
+
+
+class SharedMemory(MappedMemory):
+    """Memory over a `multiprocessing.shared_memory` segment of int cells
+
+    `SharedMemory(size=n)` creates a segment of n cells (named name, or a
+    random name), `SharedMemory(name)` attaches to an existing one from any
+    process. The size is fixed: ALLOC/DEALLOC fault since they would move
+    cells under the other processes. Atomic operations take a byte range lock
+    on the cell in a lock file next to the segment, so CAS/FADD/BARRIER work
+    between processes; plain reads and writes don't lock. `close()` detaches,
+    the creator should also `unlink()` the segment once everyone is done.
+    A barrier waiting longer than timeout seconds (None waits forever)
+    withdraws its arrival and raises MemoryFault.
+    """
+
+    def __init__(self, name=None, size=0, cell=CELL, timeout=BARRIER_TIMEOUT):
+        import fcntl
+        from multiprocessing import shared_memory
+
+        self.fcntl = fcntl
+        self.cell = cell
+        self.cell_size = array(cell).itemsize
+        self.timeout = timeout
+        if size > 0:
+            self.segment = shared_memory.SharedMemory(
+                name, create=True, size=size * self.cell_size
+            )
+        else:
+            self.segment = shared_memory.SharedMemory(name)
+        self.name = self.segment.name
+        self.cells = self.segment.buf.cast(cell)
+        self.path = os.path.join(tempfile.gettempdir(), f"{self.name}.arkhe-lock")
+
+        # fcntl locks belong to the process and closing any descriptor of
+        # the file drops them all, so handles of a segment share one
+        with _segments_lock:
+            entry = _segments.get(self.name)
+            if entry is None:
+                fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+                entry = _segments[self.name] = [threading.Lock(), fd, 0]
+            entry[2] += 1
+        self._lock, self._fd = entry[0], entry[1]
+        self.closed = False
+
+    def alloc(self, amount):
+        if amount > 0:
+            raise MemoryFault("Shared memory can't grow!")
+
+    def dealloc(self, amount, head):
+        if amount > 0:
+            raise MemoryFault("Shared memory can't shrink!")
+
+    @contextmanager
+    def _locked(self, index):
+        with self._lock:
+            self.fcntl.lockf(self._fd, self.fcntl.LOCK_EX, 1, index)
+            try:
+                yield
+            finally:
+                self.fcntl.lockf(self._fd, self.fcntl.LOCK_UN, 1, index)
+
+    def cas(self, index, expected, value):
+        with self._locked(self._span(index, 1).start):
+            return super().cas(index, expected, value)
+
+    def fetch_add(self, index, value):
+        with self._locked(self._span(index, 1).start):
+            return super().fetch_add(index, value)
+
+    def fence(self):
+        """Orders the accesses around it, taking a lock is a full barrier"""
+        with self._locked(len(self.cells)):
+            pass
+
+    def barrier(self, index, parties):
+        """Waits until parties arrivals (from any process) on the cell at
+        index, the last one resets it and bumps the generation at index + 1"""
+        cells = self._span(index, 2)
+        with self._locked(cells.start):
+            generation = self.cells[index + 1]
+            arrived = self.cells[index] + 1
+            if arrived >= parties:
+                self.cells[index] = 0
+                self.cells[index + 1] = generation + 1
+                return
+            self.cells[index] = arrived
+
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        while self.cells[index + 1] == generation:
+            if deadline is not None and time.monotonic() > deadline:
+                with self._locked(cells.start):
+                    if self.cells[index + 1] != generation:
+                        return  # released while we gave up
+                    self.cells[index] -= 1
+                raise MemoryFault("Barrier timed out!")
+            time.sleep(SPIN)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.cells.release()
+        self.segment.close()
+        with _segments_lock:
+            entry = _segments[self.name]
+            entry[2] -= 1
+            if not entry[2]:
+                os.close(entry[1])
+                del _segments[self.name]
+
+    def unlink(self):
+        """Destroys the segment and its lock file"""
+        self.segment.unlink()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.name!r}, size={len(self.cells)})"
@@ -0,0 +1,440 @@
+"""
+Peephole optimizer for assembled code.
+
+`optimize` drops NOPs, LOADs of a constant the register already holds and
+LOADs that are overwritten before being read, folds math on constants into a
+LOAD and points jumps to unconditional jumps at their final target.
+
+Jump distances and absolute targets are counted in code words and come from
+registers, so before anything is moved every jump has to be resolved: all
+paths reaching it must LOAD the same int into its register (registers can be
+set from outside, so the initial value doesn't count). If any jump can't be
+resolved the code is returned untouched. A resolved jump whose LOAD can't be
+rewritten (the register is read by something else too, or by a jump needing
+another value) keeps its distance instead, the words it spans aren't touched.
+Registers only read by jumps end up holding the relocated constants.
+Programs that SPAWN threads are left alone, thread entry points are code
+offsets too but they aren't tracked.
+"""
+import operator
+from bisect import bisect
+from dataclasses import dataclass
+from typing import List
+
+from arkhe.verifier import VerificationError, verify
+from arkhe.vm import (
+    COMPARISON_OPS,
+    ArkheException,
+    INSTR_TERM,
+    JUMP_OPS,
+    MATH_OPS,
+    VECTOR_REDUCE_OPS,
+    Operation,
+    load_const,
+)
+
+ENTRY = -1  # definition of the values registers have before the program runs
+FORWARD_JUMPS = frozenset({Operation.JMPF, Operation.JFE, Operation.JFN})
+UNCONDITIONAL_JUMPS = frozenset({Operation.JMP, Operation.JMPF, Operation.JMPB})
+ENDS_BLOCK = frozenset({*JUMP_OPS, Operation.HLT})
+FOLDABLE = {
+    Operation.ADD: operator.add,
+    Operation.SUB: operator.sub,
+    Operation.MUL: operator.mul,
+}
+MAX_CONST = 0xFFFF
+
+
+@dataclass
+class Optimized:
+    code: List[int]
+    saved: int
+
+
+def reads(instr):
+    operation, operands = instr.operation, instr.operands
+    if operation in MATH_OPS or operation in COMPARISON_OPS:
+        return operands[:2]
+    elif operation in (Operation.INSERT, Operation.SYMSET, Operation.MEMSUM):
+        return operands[:2]
+    elif operation in (
+        Operation.MEMCPY,
+        Operation.MEMSET,
+        Operation.MEMCMP,
+        Operation.CAS,
+    ):
+        return operands[:3]
+    elif operation in (Operation.FADD, Operation.BARRIER):
+        return operands[:2]
+    elif operation in (Operation.SPAWN, Operation.JOIN):
+        return operands[:1]
+    elif operation is Operation.VLOAD:
+        return operands[1:3]
+    elif operation is Operation.VSTORE:
+        return operands[1:2]
+    elif operation in JUMP_OPS or operation in (
+        Operation.ALLOC,
+        Operation.READ,
+        Operation.SYMREAD,
+    ):
+        return operands[:1]
+    elif operation is Operation.DEALLOC:
+        return operands[1:2]
+    elif operation is Operation.CCALL:
+        return [operands[0], *operands[1:-1]]
+    return []
+
+
+def writes(instr):
+    operation, operands = instr.operation, instr.operands
+    if operation is Operation.LOAD:
+        return operands[0]
+    elif operation in MATH_OPS:
+        return operands[2]
+    elif operation in (
+        Operation.READ,
+        Operation.SYMREAD,
+        Operation.CCALL,
+        Operation.CAS,
+        Operation.SPAWN,
+    ):
+        return operands[1]
+    elif operation in (Operation.MEMSUM, Operation.FADD):
+        return operands[2]
+    elif operation in VECTOR_REDUCE_OPS:
+        return operands[1]
+    return None
+
+
+def constant(instr):
+    if instr.operation is not Operation.LOAD:
+        return None
+    try:
+        return load_const(instr)
+    except ArkheException:
+        return None  # pooled, the pool isn't known here
+
+
+def optimize(code):
+    """Returns an Optimized with the new code and the number of words saved"""
+    code = list(code)
+    try:
+        decoded = verify(code)
+    except VerificationError:
+        return Optimized(code, 0)
+    if not decoded:
+        return Optimized(code, 0)
+    if any(instr.operation is Operation.SPAWN for instr, _ in decoded.values()):
+        return Optimized(code, 0)
+
+    optimizer = Optimizer(code, decoded)
+    if not optimizer.resolve():
+        return Optimized(code, 0)
+
+    result = optimizer.rewrite()
+    return Optimized(result, len(code) - len(result))
+
+
+class Optimizer:
+    def __init__(self, code, decoded):
+        self.code = code
+        self.offsets = sorted(decoded)
+        self.instrs = [decoded[offset][0] for offset in self.offsets]
+        self.index = {offset: n for n, offset in enumerate(self.offsets)}
+        self.index[len(code)] = len(self.instrs)
+        self.constants = [constant(instr) for instr in self.instrs]
+        self.targets = {}
+        self.sources = {}
+
+    def size(self, n):
+        return len(self.instrs[n].operands) + 2
+
+    def end(self, n):
+        return self.offsets[n] + self.size(n)
+
+    def target_of(self, n, value):
+        operation = self.instrs[n].operation
+        if operation in FORWARD_JUMPS:
+            return self.end(n) + value
+        elif operation is Operation.JMPB:
+            return self.end(n) - value
+        return value
+
+    def resolve(self):
+        """Finds the target of every jump, returns False if one is unknown
+
+        Reaching definitions are propagated between block starts with a
+        worklist; a jump's target becomes a new block start (and an edge) as
+        soon as its register is known. Definitions only grow, so a jump whose
+        register ever sees two values or an outside value stays unknown.
+        """
+        eta = len(self.instrs)
+        self.starts = [0]
+        self.ins = {0: {}}  # registers missing from a state hold ENTRY
+        for n, instr in enumerate(self.instrs):
+            if instr.operation in ENDS_BLOCK and n + 1 < eta:
+                self.starts.append(n + 1)
+                self.ins.setdefault(n + 1, None)
+
+        pending = [0]
+        while pending:
+            start = pending.pop()
+            state = dict(self.ins[start])
+            n = start
+            while True:
+                instr = self.instrs[n]
+                if instr.operation in JUMP_OPS:
+                    target = self.jump(n, state)
+                    if target is None:
+                        return False
+                    if target < eta:
+                        if target not in self.ins:
+                            self.split(target, pending)
+                        self.flow(target, state, pending)
+                    if instr.operation in UNCONDITIONAL_JUMPS:
+                        break
+
+                register = writes(instr)
+                if register is not None:
+                    state[register] = frozenset({n})
+                n += 1
+                if n >= eta:
+                    break
+                if n in self.ins:
+                    self.flow(n, state, pending)
+                    break
+
+        jumps = [n for n, instr in enumerate(self.instrs) if instr.operation in JUMP_OPS]
+        if len(jumps) != len(self.targets):
+            return False  # unreachable jumps can't be relocated
+        self.readers = self.read_definitions()
+        return True
+
+    def jump(self, n, state):
+        found = state.get(self.instrs[n].operands[0], frozenset({ENTRY}))
+        values = {self.constants[d] if d != ENTRY else None for d in found}
+        if len(values) != 1:
+            return None
+        value = values.pop()
+        if type(value) is not int:
+            return None
+        target = self.target_of(n, value)
+        if target not in self.index:
+            return None
+
+        self.targets[n], self.sources[n] = target, found
+        return self.index[target]
+
+    def split(self, start, pending):
+        """Makes start a block start, rewalking the block it falls into"""
+        position = bisect(self.starts, start)
+        self.starts.insert(position, start)
+        self.ins[start] = None
+        enclosing = self.starts[position - 1]
+        if self.ins[enclosing] is not None:
+            pending.append(enclosing)
+
+    def flow(self, start, state, pending):
+        merged = merge(self.ins[start], state)
+        if merged != self.ins[start]:
+            self.ins[start] = merged
+            pending.append(start)
+
+    def read_definitions(self):
+        """Returns the instructions reading each definition"""
+        readers = {}
+        for start, stop in self.blocks():
+            if self.ins[start] is None:
+                continue  # unreachable
+            state = dict(self.ins[start])
+            for n in range(start, stop):
+                instr = self.instrs[n]
+                for register in reads(instr):
+                    for definition in state.get(register, (ENTRY,)):
+                        readers.setdefault(definition, set()).add(n)
+                register = writes(instr)
+                if register is not None:
+                    state[register] = frozenset({n})
+        return readers
+
+    def blocks(self):
+        """Returns [(start, stop)] over the instruction indices"""
+        return list(zip(self.starts, [*self.starts[1:], len(self.instrs)]))
+
+    def rewrite(self):
+        self.frozen = set()
+        self.direct = set()  # jumps that can't skip over jumps
+        while True:
+            self.plan()
+            conflicts = self.relocate()
+            if not conflicts:
+                return self.emit()
+
+            for n in conflicts:
+                if n not in self.direct and self.final[n] != self.targets[n]:
+                    self.direct.add(n)
+                else:
+                    self.frozen.update(self.span(n))
+
+    def span(self, n):
+        """Returns the instructions whose sizes make up jump n's constant"""
+        operation, target = self.instrs[n].operation, self.index[self.targets[n]]
+        if operation in FORWARD_JUMPS:
+            return range(n + 1, target)
+        elif operation is Operation.JMPB:
+            return range(target, n + 1)
+        return range(target)
+
+    def plan(self):
+        """Decides which instructions are removed (None) or replaced"""
+        self.actions = {}
+        self.jump_sources = set().union(*self.sources.values())
+        for start, stop in self.blocks():
+            known, unread = {}, {}
+            for n in range(start, stop):
+                if n not in self.frozen and self.simplify(n, known, unread):
+                    continue
+                self.track(n, known, unread)
+
+    def simplify(self, n, known, unread):
+        """Removes or folds instruction n, returns False if it is kept"""
+        instr = self.instrs[n]
+        operation, operands = instr.operation, instr.operands
+        if operation is Operation.NOP:
+            self.actions[n] = None
+            return True
+
+        if operation in FOLDABLE:
+            values = [known.get(register, (None,))[0] for register in operands[:2]]
+            if not all(type(value) is int for value in values):
+                return False
+            value = FOLDABLE[operation](*values)
+            if not 0 <= value <= MAX_CONST:
+                return False
+            self.actions[n] = [operands[2], value >> 8, value & 0xFF]
+            self.define(operands[2], value, n, known, unread)
+            return True
+
+        if operation is Operation.LOAD and n not in self.jump_sources:
+            current, value = known.get(operands[0]), self.constants[n]
+            if (
+                current is not None
+                and value is not None
+                and current[1] not in self.jump_sources
+                and type(current[0]) is type(value)
+                and current[0] == value
+            ):
+                self.actions[n] = None
+                return True
+        return False
+
+    def track(self, n, known, unread):
+        instr = self.instrs[n]
+        for register in reads(instr):
+            unread.pop(register, None)
+        if instr.operation not in (Operation.LOAD, Operation.NOP):
+            unread.clear()  # a fault here would show the registers
+
+        register = writes(instr)
+        if register is None:
+            return
+        if instr.operation is Operation.LOAD:
+            self.define(register, self.constants[n], n, known, unread)
+        else:
+            known.pop(register, None)
+
+    def define(self, register, value, n, known, unread):
+        """Records that n LOADs value, the LOAD it overwrites unread is dead"""
+        previous = unread.get(register)
+        if (
+            previous is not None
+            and previous not in self.frozen
+            and previous not in self.jump_sources
+        ):
+            self.actions[previous] = None
+        known[register] = value, n
+        unread[register] = n
+
+    def relocate(self):
+        """Computes the new jump constants, returns the conflicting jumps"""
+        self.moved = [0] * (len(self.instrs) + 1)
+        for n in range(len(self.instrs)):
+            size = 0 if self.actions.get(n, True) is None else self.size(n)
+            self.moved[n + 1] = self.moved[n] + size
+
+        self.final = {n: self.follow(n) for n in self.targets}
+        values = {}
+        for n, target in self.final.items():
+            new_target, new_end = self.moved[self.index[target]], self.moved[n + 1]
+            operation = self.instrs[n].operation
+            if operation in FORWARD_JUMPS:
+                value = new_target - new_end
+            elif operation is Operation.JMPB:
+                value = new_end - new_target
+            else:
+                value = new_target
+            for source in self.sources[n]:
+                values.setdefault(source, set()).add(value)
+
+        self.rewrites, conflicts = {}, set()
+        for source, needed in values.items():
+            if needed == {self.constants[source]}:
+                continue
+            readers = self.readers.get(source, ())
+            value = min(needed)
+            if (
+                len(needed) == 1
+                and 0 <= value <= MAX_CONST
+                and all(reader in self.targets for reader in readers)
+            ):
+                self.rewrites[source] = value
+            else:
+                conflicts.update(
+                    reader for reader in readers if reader in self.targets
+                )
+        return conflicts
+
+    def follow(self, n):
+        """Returns the final target of jump n, through unconditional jumps"""
+        target, seen = self.targets[n], {n}
+        if n in self.direct:
+            return target
+
+        while True:
+            following = self.index[target]
+            while self.actions.get(following, True) is None:
+                following += 1  # removed instructions fall through
+            if (
+                following in seen
+                or following not in self.targets
+                or self.instrs[following].operation not in UNCONDITIONAL_JUMPS
+            ):
+                return target
+            seen.add(following)
+            target = self.targets[following]
+
+    def emit(self):
+        result = []
+        for n, instr in enumerate(self.instrs):
+            action = self.actions.get(n, instr.operands)
+            if action is None:
+                continue
+            operation = Operation.LOAD if n in self.actions else instr.operation
+            operands = list(action)
+            if n in self.rewrites:
+                value = self.rewrites[n]
+                operands[1:3] = [value >> 8, value & 0xFF]
+            result.extend([operation, *operands, INSTR_TERM])
+        return [int(word) for word in result]
+
+
+def merge(current, incoming):
+    if current is None:
+        return dict(incoming)
+
+    merged = dict(current)
+    for register in set(current) | set(incoming):
+        left = current.get(register, frozenset({ENTRY}))
+        right = incoming.get(register, frozenset({ENTRY}))
+        merged[register] = left | right
+    return merged
@@ -0,0 +1,119 @@
+"""
+Running many independent programs on a process pool.
+
+`run` takes a list of programs (code lists or `binary.Program`s) and
+optionally initial states, a mapping or sequence of register values per
+job. With one program every state is a job on it, otherwise there is a job
+per program (each with the state at the same position, if given). The
+programs are packed into the `.arkc` format once and handed to every worker
+when it starts, so a job only carries its program's index and its state.
+
+Every job returns a `Result` with the final registers, a symtable snapshot,
+the counter and the exception the program raised (HLT included). A job that
+runs past its `instructions` or `seconds` budget (see `Arkhe.eval`) stops
+with BudgetExceeded.
+
+Jobs get their own `Memory` unless memory names a `SharedMemory` segment,
+then every worker attaches to it and the jobs share its cells (coordinating
+with CAS/FADD/BARRIER).
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+
+from arkhe import binary
+from arkhe.controller import Arkhe
+from arkhe.memory import SharedMemory
+from arkhe.vm import BudgetExceeded  # raised by the jobs past their budget
+
+_programs = []  # unpacked in every worker by _setup
+_shared = []  # the attached SharedMemory, if any
+
+
+@dataclass
+class Result:
+    registers: List[Any]
+    symtable: Dict[Any, Any] = field(default_factory=dict)
+    counter: int = 0
+    error: Optional[Exception] = None
+
+
+def run(
+    programs,
+    states=None,
+    workers=None,
+    chunksize=None,
+    instructions=None,
+    seconds=None,
+    memory=None,
+):
+    """Returns a Result per job, in order
+
+    workers defaults to the number of CPUs, 0 runs the jobs in this process.
+    chunksize is the number of jobs sent to a worker at once. memory is the
+    name of a SharedMemory segment the jobs use as their memory.
+    """
+    packed = [pack(program) for program in programs]
+    if states is None:
+        jobs = [(index, None) for index in range(len(packed))]
+    elif len(packed) == 1:
+        jobs = [(0, state) for state in states]
+    else:
+        states = list(states)
+        if len(states) != len(packed):
+            raise ValueError(f"{len(states)} states for {len(packed)} programs")
+        jobs = list(enumerate(states))
+    jobs = [(index, state, instructions, seconds) for index, state in jobs]
+
+    if workers == 0:
+        _setup(packed, memory)
+        try:
+            return list(map(_run, jobs))
+        finally:
+            _setup([])
+
+    workers = workers or os.cpu_count() or 1
+    if chunksize is None:
+        chunksize = max(1, len(jobs) // (workers * 4))
+    with ProcessPoolExecutor(
+        workers, initializer=_setup, initargs=(packed, memory)
+    ) as pool:
+        return list(pool.map(_run, jobs, chunksize=chunksize))
+
+
+def pack(program):
+    if isinstance(program, binary.Program):
+        return binary.dumps(program.code, program.consts)
+    return binary.dumps(program)
+
+
+def _setup(packed, memory=None):
+    _programs[:] = map(binary.loads, packed)
+    for shared in _shared:
+        shared.close()
+    _shared[:] = [] if memory is None else [SharedMemory(memory)]
+
+
+def _run(job):
+    index, state, instructions, seconds = job
+    program = _programs[index]
+    vm = Arkhe(
+        program.code,
+        consts=program.consts,
+        memory=_shared[0] if _shared else None,
+    )
+    if isinstance(state, dict):
+        for register, value in state.items():
+            vm.registers[int(register)] = value
+    elif state is not None:
+        for register, value in enumerate(state):
+            vm.registers[register] = value
+
+    error = None
+    try:
+        vm.eval(instructions, seconds)
+    except Exception as exc:
+        error = exc
+    return Result(list(vm.registers.data), dict(vm.symtable), vm.counter, error)
+
@@ -0,0 +1,64 @@
+"""
+Constant pool.
+
+A LOAD tagged with `TypeTable.POOL` loads the pool entry at its 16 bit
+immediate, so ints of any width, strings and bytes don't have to be spelled
+out in code words. The VM also interns the inline STR/BYT constants it
+decodes through the pool: each one is built once, and equal constants are
+the same object, which keeps symtable lookups cheap. Interned constants are
+kept apart from the entries, so they don't count against MAX_CONSTANTS or
+end up in the pool `binary` stores next to the code.
+"""
+from collections.abc import Sequence
+
+from arkhe.utils import create_instr
+from arkhe.vm import InvalidConstant, TypeTable
+
+MAX_CONSTANTS = 0x10000
+
+
+class ConstantPool(Sequence):
+    def __init__(self, values=()):
+        self.values = []
+        self._index = {}
+        self._interned = {}
+        for value in values:
+            self._append(value)
+
+    def _append(self, value):
+        if len(self.values) >= MAX_CONSTANTS:
+            raise InvalidConstant("Constant pool is full!")
+        index = len(self.values)
+        self.values.append(value)
+        self._index.setdefault((type(value), value), index)
+        return index
+
+    def add(self, value):
+        """Returns the index of value, adding it if it isn't pooled yet"""
+        index = self._index.get((type(value), value))
+        if index is None:
+            index = self._append(value)
+        return index
+
+    def intern(self, value):
+        """Returns the entry equal to value, or the first interned value
+        equal to it (without adding an entry)"""
+        key = (type(value), value)
+        index = self._index.get(key)
+        if index is not None:
+            return self.values[index]
+        return self._interned.setdefault(key, value)
+
+    def load(self, register, value):
+        """Returns a LOAD of value into register through the pool"""
+        index = self.add(value)
+        return create_instr("load", register, index >> 8, index & 0xFF, TypeTable.POOL)
+
+    def __getitem__(self, index):
+        return self.values[index]
+
+    def __len__(self):
+        return len(self.values)
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.values!r})"
@@ -0,0 +1,68 @@
+"""
+Cooperative asyncio execution.
+
+`evaluate` is an async `eval()`: it runs `quantum` instructions, then yields
+to the event loop, so many programs can share one loop. CCALLs run in a
+thread executor (unless offload is False) and the program waits for them
+without blocking the loop.
+
+`Scheduler` interleaves many VMs on the running loop. asyncio resumes ready
+tasks in order, so VMs take turns; a VM's priority multiplies the
+instructions it runs per turn.
+"""
+import asyncio
+
+from arkhe.vm import Operation
+
+QUANTUM = 1000
+
+
+async def evaluate(vm, quantum=QUANTUM, offload=True, executor=None):
+    """Runs vm to the end like eval(), yielding every quantum instructions
+
+    Returns vm. CCALLs run on executor (the loop's default one if None).
+    """
+    loop = asyncio.get_running_loop()
+    while vm.counter < len(vm.code):
+        for _ in range(quantum):
+            if vm.counter >= len(vm.code):
+                break
+            if offload and vm.code[vm.counter] == Operation.CCALL:
+                await loop.run_in_executor(executor, vm.exc_instr)
+            else:
+                vm.exc_instr()
+        await asyncio.sleep(0)
+    return vm
+
+
+class Scheduler:
+    def __init__(self, quantum=QUANTUM, offload=True, executor=None):
+        self.quantum = quantum
+        self.offload = offload
+        self.executor = executor
+        self.tasks = set()
+
+    def spawn(self, vm, priority=1):
+        """Starts running vm, returns its task (the result is vm)
+
+        priority is the number of quanta vm runs per turn.
+        """
+        if priority < 1:
+            raise ValueError("Priority must be at least 1!")
+        task = asyncio.get_running_loop().create_task(
+            evaluate(vm, self.quantum * priority, self.offload, self.executor)
+        )
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def join(self):
+        """Waits until every spawned VM stops (faults don't propagate)"""
+        while self.tasks:
+            await asyncio.wait(set(self.tasks))
+
+    def __len__(self):
+        return len(self.tasks)
+
+    def __repr__(self):
+        return f"Scheduler({len(self.tasks)} running, quantum={self.quantum})"
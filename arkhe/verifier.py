@@ -0,0 +1,106 @@
+"""
+Static bytecode verifier.
+
+`verify` checks a whole program in one linear pass: known opcodes, operand
+counts, register indices, LOAD type tags, DEALLOC head flags and the final
+INSTR_TERM. It returns the decoded instructions so `Arkhe` can run verified
+code without decoding (and checking) it again.
+"""
+from arkhe.vm import (
+    INSTR_TERM,
+    OPERAND_COUNTS,
+    REGISTER_OPERANDS,
+    VECTOR_OPERANDS,
+    VECTOR_REGISTERS,
+    ArkheException,
+    Instr,
+    Operation,
+    TypeTable,
+)
+
+TYPE_TAGS = range(0xFD0, 0xFE0)
+KNOWN_TAGS = frozenset(TypeTable)
+OPERATIONS = {operation.value: operation for operation in Operation}
+RULES = {
+    operation: (
+        *OPERAND_COUNTS.get(operation, (0, None)),
+        REGISTER_OPERANDS.get(operation, ()),
+        VECTOR_OPERANDS.get(operation, ()),
+    )
+    for operation in Operation
+}
+
+
+class VerificationError(ArkheException):
+    def __init__(self, offset, reason):
+        super().__init__(f"{offset}: {reason}")
+        self.offset = offset
+        self.reason = reason
+
+
+def verify(code, registers=32, consts=None, vectors=VECTOR_REGISTERS):
+    """Returns {offset: (instr, end)} for every instruction of code
+
+    POOL constants are checked against consts when it is given.
+    """
+    decoded = {}
+    offset, eta = 0, len(code)
+    find = getattr(code, "index", None)
+    while offset < eta:
+        operation = OPERATIONS.get(code[offset])
+        if operation is None:
+            raise VerificationError(offset, f"unknown opcode {code[offset]:#x}")
+
+        try:
+            if find is not None:
+                end = find(INSTR_TERM, offset + 1)
+            else:
+                end = next(
+                    n for n in range(offset + 1, eta) if code[n] == INSTR_TERM
+                )
+        except (ValueError, StopIteration):
+            raise VerificationError(offset, "instruction isn't terminated")
+
+        operands = list(code[offset + 1 : end])
+        least, most, positions, vector_positions = RULES[operation]
+        if len(operands) < least or (most is not None and len(operands) > most):
+            raise VerificationError(
+                offset, f"{operation.name} takes {least}..{most} operands"
+            )
+
+        if positions is None:
+            positions = range(len(operands))
+        for position in positions:
+            if not 0 <= operands[position] < registers:
+                raise VerificationError(
+                    offset, f"register {operands[position]} doesn't exist"
+                )
+        for position in vector_positions:
+            if not 0 <= operands[position] < vectors:
+                raise VerificationError(
+                    offset, f"vector register {operands[position]} doesn't exist"
+                )
+
+        if operation is Operation.LOAD:
+            check_load(offset, operands, consts)
+        elif operation is Operation.DEALLOC and operands[0] not in (0, 1):
+            raise VerificationError(offset, "DEALLOC head flag must be 0 or 1")
+
+        decoded[offset] = Instr(operation, operands), end + 1
+        offset = end + 1
+    return decoded
+
+
+def check_load(offset, operands, consts):
+    tag = operands[-1]
+    if tag in TYPE_TAGS and tag not in KNOWN_TAGS:
+        raise VerificationError(offset, f"unknown type tag {tag:#x}")
+    if tag == TypeTable.INT or tag not in TYPE_TAGS:
+        if len(operands) < 3:
+            raise VerificationError(offset, "LOAD of an int takes 2 bytes")
+    elif tag == TypeTable.POOL:
+        if len(operands) < 4:
+            raise VerificationError(offset, "LOAD of a pooled constant takes 2 bytes")
+        index = (operands[1] << 8) | operands[2]
+        if consts is not None and index >= len(consts):
+            raise VerificationError(offset, f"no constant at {index}")
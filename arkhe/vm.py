@@ -21,8 +21,8 @@ class ArkheException(Exception):
 
 
 class HLT(ArkheException):
-    def __init__(self):
-        super().__init__("Program stopped!")
+    def __init__(self, message="Program stopped!"):  # unpickled with args
+        super().__init__(message)
 
 
 class InsufficientOperands(ArkheException):
@@ -37,10 +37,33 @@ class UnknownSymbol(ArkheException):
     pass
 
 
+class VectorFault(ArkheException):
+    pass
+
+
+class InvalidConstant(ArkheException):
+    pass
+
+
+class ThreadError(ArkheException):
+    pass
+
+
+class BudgetExceeded(ArkheException):
+    """eval() ran past its instruction or time budget, the VM stops after a
+    backward jump and another eval() continues from there"""
+
+
+class Switch(Exception):
+    """Raised by SPAWN/YIELD/JOIN to hand over to the green thread scheduler
+    (`Arkhe.schedule`), the instruction itself is complete"""
+
+
 class TypeTable(IntEnum):
     INT = 0xFD0
     STR = 0xFD1
     BYT = 0xFD2
+    POOL = 0xFD3
 
 
 class Operation(IntEnum):
@@ -68,6 +91,32 @@ class Operation(IntEnum):
     READ = 21
     SYMSET = 22
     SYMREAD = 23
+    MEMCPY = 24
+    MEMSET = 25
+    MEMSUM = 26
+    MEMCMP = 27
+    VLOAD = 28
+    VSTORE = 29
+    VADD = 30
+    VSUB = 31
+    VMUL = 32
+    VTRUEDIV = 33
+    VEQ = 34
+    VNE = 35
+    VGT = 36
+    VLT = 37
+    VGE = 38
+    VLE = 39
+    VSUM = 40
+    VMIN = 41
+    VMAX = 42
+    CAS = 43
+    FADD = 44
+    FENCE = 45
+    BARRIER = 46
+    SPAWN = 47
+    JOIN = 48
+    YIELD = 49
     CCALL = 0xFCF
     NOP = 0xFEE
     HLT = 0xFEF
@@ -76,12 +125,120 @@ class Operation(IntEnum):
         return self.name.capitalize().ljust(7)
 
 
+MATH_OPS = (Operation.ADD, Operation.SUB, Operation.MUL, Operation.TRUEDIV)
+COMPARISON_OPS = (
+    Operation.EQ,
+    Operation.NE,
+    Operation.GT,
+    Operation.LT,
+    Operation.GE,
+    Operation.LE,
+)
+BULK_OPS = (Operation.MEMCPY, Operation.MEMSET, Operation.MEMSUM, Operation.MEMCMP)
+VECTOR_MATH_OPS = (Operation.VADD, Operation.VSUB, Operation.VMUL, Operation.VTRUEDIV)
+VECTOR_COMPARISON_OPS = (
+    Operation.VEQ,
+    Operation.VNE,
+    Operation.VGT,
+    Operation.VLT,
+    Operation.VGE,
+    Operation.VLE,
+)
+VECTOR_REDUCE_OPS = (Operation.VSUM, Operation.VMIN, Operation.VMAX)
+JUMP_OPS = (
+    Operation.JMP,
+    Operation.JMPF,
+    Operation.JMPB,
+    Operation.JEQ,
+    Operation.JNE,
+    Operation.JFE,
+    Operation.JFN,
+)
+
+# Positions of the operands that name registers, None means all of them
+REGISTER_OPERANDS = {
+    Operation.LOAD: (0,),
+    **dict.fromkeys(MATH_OPS, (0, 1, 2)),
+    **dict.fromkeys(COMPARISON_OPS, (0, 1)),
+    **dict.fromkeys(JUMP_OPS, (0,)),
+    Operation.ALLOC: (0,),
+    Operation.DEALLOC: (1,),
+    Operation.INSERT: (0, 1),
+    Operation.READ: (0, 1),
+    Operation.SYMSET: (0, 1),
+    Operation.SYMREAD: (0, 1),
+    **dict.fromkeys(BULK_OPS, (0, 1, 2)),
+    Operation.VLOAD: (1, 2),
+    Operation.VSTORE: (1,),
+    **dict.fromkeys(VECTOR_MATH_OPS, ()),
+    **dict.fromkeys(VECTOR_COMPARISON_OPS, ()),
+    **dict.fromkeys(VECTOR_REDUCE_OPS, (1,)),
+    Operation.CAS: (0, 1, 2),
+    Operation.FADD: (0, 1, 2),
+    Operation.FENCE: (),
+    Operation.BARRIER: (0, 1),
+    Operation.SPAWN: (0, 1),
+    Operation.JOIN: (0,),
+    Operation.YIELD: (),
+    Operation.CCALL: None,
+    Operation.NOP: (),
+    Operation.HLT: (),
+}
+
+# Minimum and maximum operand counts, None means any number of operands
+OPERAND_COUNTS = {
+    Operation.LOAD: (1, None),
+    **dict.fromkeys(MATH_OPS, (3, 3)),
+    **dict.fromkeys(COMPARISON_OPS, (2, 2)),
+    **dict.fromkeys(JUMP_OPS, (1, 1)),
+    Operation.ALLOC: (1, 1),
+    Operation.DEALLOC: (2, 2),
+    Operation.INSERT: (2, 2),
+    Operation.READ: (2, 2),
+    Operation.SYMSET: (2, 2),
+    Operation.SYMREAD: (2, 2),
+    **dict.fromkeys(BULK_OPS, (3, 3)),
+    Operation.VLOAD: (3, 3),
+    Operation.VSTORE: (2, 2),
+    **dict.fromkeys(VECTOR_MATH_OPS, (3, 3)),
+    **dict.fromkeys(VECTOR_COMPARISON_OPS, (3, 3)),
+    **dict.fromkeys(VECTOR_REDUCE_OPS, (2, 2)),
+    Operation.CAS: (3, 3),
+    Operation.FADD: (3, 3),
+    Operation.FENCE: (0, None),
+    Operation.BARRIER: (2, 2),
+    Operation.SPAWN: (2, 2),
+    Operation.JOIN: (1, 1),
+    Operation.YIELD: (0, None),
+    Operation.CCALL: (2, None),
+    Operation.NOP: (0, None),
+    Operation.HLT: (0, None),
+}
+
+# Positions of the operands that name vector registers (see
+# arkhe.controller.Vectors)
+VECTOR_REGISTERS = 8
+VECTOR_OPERANDS = {
+    Operation.VLOAD: (0,),
+    Operation.VSTORE: (0,),
+    **dict.fromkeys(VECTOR_MATH_OPS, (0, 1, 2)),
+    **dict.fromkeys(VECTOR_COMPARISON_OPS, (0, 1, 2)),
+    **dict.fromkeys(VECTOR_REDUCE_OPS, (0,)),
+}
+
+
+UNDECODED = object()
+UNSET = object()  # value of symtable slots whose name isn't set
+
+
 @dataclass
 class Instr:
     operation: Operation
     operands: List[int]
     def __post_init__(self):
         self.op = 0
+        self.const = UNDECODED
+        self.cache = None
         if not isinstance(self.operation, Operation):
             self.operation = Operation(self.operation)
 
@@ -120,22 +277,40 @@ class VM:
         return self.instrset.get(instr.operation)(self.arkhe, instr)
 
 
+def load_const(instr, consts=None):
+    """Returns the constant of a LOAD instr, it is decoded only once
+
+    consts is the constant pool, POOL constants are read from it and decoded
+    strings and bytes are interned into it.
+    """
+    if instr.const is UNDECODED:
+        instr.const = decode_const(instr.operands, consts)
+    return instr.const
+
+
+def decode_const(operands, consts=None):
+    tag = operands[-1] if operands else None
+    if tag == TypeTable.STR or tag == TypeTable.BYT:
+        value = "".join(map(chr, operands[1:-1]))
+        if tag == TypeTable.BYT:
+            value = bytes(value, "utf8")
+        return value if consts is None else consts.intern(value)
+
+    if len(operands) < (4 if tag == TypeTable.POOL else 3):
+        raise InsufficientOperands()
+    value = (operands[1] << 8) | operands[2]
+    if tag == TypeTable.POOL:
+        try:
+            return consts[value]
+        except (IndexError, TypeError):
+            raise InvalidConstant(f"No constant at {value}!")
+    return value
+
+
 @VM.instr(Operation.LOAD)
 def load(vm, instr):
     target = instr.get_8()
-    try:
-        typed = TypeTable(instr.operands[-1])
-    except ValueError:
-        typed = TypeTable.INT
-
-    if typed is TypeTable.INT:
-        value = instr.get_16()
-    elif typed is TypeTable.STR:
-        value = "".join(map(chr, instr.operands[1:-1]))
-    elif typed is TypeTable.BYT:
-        value = bytes("".join(map(chr, instr.operands[1:-1])), "utf8")
-
-    vm.registers[target] = value
+    vm.registers.data[target] = load_const(instr, vm.consts)
 
 
 @VM.instr(Operation.ADD)
@@ -143,11 +318,11 @@ def load(vm, instr):
 @VM.instr(Operation.MUL)
 @VM.instr(Operation.TRUEDIV)
 def math(vm, instr):
-    operand1 = vm.registers[instr.get_8()]
-    operand2 = vm.registers[instr.get_8()]
-    vm.registers[instr.get_8()] = getattr(operator, instr.operation.name.lower())(
-        operand1, operand2
-    )
+    operand1 = vm.registers.data[instr.get_8()]
+    operand2 = vm.registers.data[instr.get_8()]
+    vm.registers.data[instr.get_8()] = getattr(
+        operator, instr.operation.name.lower()
+    )(operand1, operand2)
 
 
 @VM.instr(Operation.EQ)
@@ -157,71 +332,71 @@ def math(vm, instr):
 @VM.instr(Operation.GT)
 @VM.instr(Operation.LT)
 def comparison(vm, instr):
-    operand1 = vm.registers[instr.get_8()]
-    operand2 = vm.registers[instr.get_8()]
+    operand1 = vm.registers.data[instr.get_8()]
+    operand2 = vm.registers.data[instr.get_8()]
     vm._eqflag = getattr(operator, instr.operation.name.lower())(operand1, operand2)
 
 
 @VM.instr(Operation.JMP)
 def jmp(vm, instr):
-    vm.counter = vm.registers[instr.get_8()]
+    vm.counter = vm.registers.data[instr.get_8()]
 
 
 @VM.instr(Operation.JMPF)
 def jmp_forward(vm, instr):
-    value = vm.registers[instr.get_8()]
+    value = vm.registers.data[instr.get_8()]
     vm.counter += value
 
 
 @VM.instr(Operation.JMPB)
 def jmp_backward(vm, instr):
-    value = vm.registers[instr.get_8()]
+    value = vm.registers.data[instr.get_8()]
     vm.counter -= value
 
 
 @VM.instr(Operation.JEQ)
 def jmp_ifeq(vm, instr):
-    value = vm.registers[instr.get_8()]
+    value = vm.registers.data[instr.get_8()]
     if vm._eqflag:
         vm.counter = value
 
 
 @VM.instr(Operation.JNE)
 def jmp_ifne(vm, instr):
-    value = vm.registers[instr.get_8()]
+    value = vm.registers.data[instr.get_8()]
     if not vm._eqflag:
         vm.counter = value
 
 
 @VM.instr(Operation.JFE)
 def jmpf_ifeq(vm, instr):
-    value = vm.registers[instr.get_8()]
+    value = vm.registers.data[instr.get_8()]
     if vm._eqflag:
         vm.counter += value
 
 
 @VM.instr(Operation.JFN)
 def jmpf_ifne(vm, instr):
-    value = vm.registers[instr.get_8()]
+    value = vm.registers.data[instr.get_8()]
     if not vm._eqflag:
         vm.counter += value
         
 @VM.instr(Operation.ALLOC)
 def mem_alloc(vm, instr):
-    value = vm.registers[instr.get_8()]
+    value = vm.registers.data[instr.get_8()]
     vm.memory.alloc(value)
 
 
 @VM.instr(Operation.DEALLOC)
 def mem_dealloc(vm, instr):
     head = instr.get_8()
-    vm.memory.dealloc(vm.registers[instr.get_8()], head=head)
+    vm.memory.dealloc(vm.registers.data[instr.get_8()], head=head)
 
 
 @VM.instr(Operation.INSERT)
 def mem_insert(vm, instr):
-    position = vm.registers[instr.get_8()]
-    value = vm.registers[instr.get_8()]
+    position = vm.registers.data[instr.get_8()]
+    value = vm.registers.data[instr.get_8()]
     try:
         vm.memory[position] = value
     except IndexError:
@@ -230,35 +405,217 @@ def mem_insert(vm, instr):
 
 @VM.instr(Operation.READ)
 def mem_read(vm, instr):
-    position = vm.registers[instr.get_8()]
+    position = vm.registers.data[instr.get_8()]
     try:
-        vm.registers[instr.get_8()] = vm.memory[position]
+        vm.registers.data[instr.get_8()] = vm.memory[position]
     except IndexError:
         raise MemoryFault("Read operation to not owned area!")
 
 
+def sym_slot(vm, instr, name):
+    """Returns the symtable slot of name, cached on instr while name (the
+    same object, e.g a pooled constant) and the symtable stay the same"""
+    cache = instr.cache
+    if cache is None or cache[0] is not name or cache[1] is not vm.symtable:
+        cache = instr.cache = name, vm.symtable, vm.symtable.slot(name)
+    return cache[2]
+
+
 @VM.instr(Operation.SYMSET)
 def sym_set(vm, instr):
-    name = vm.registers[instr.get_8()]
-    value = vm.registers[instr.get_8()]
-    vm.symtable[name] = value
+    name = vm.registers.data[instr.get_8()]
+    value = vm.registers.data[instr.get_8()]
+    vm.symtable.store(sym_slot(vm, instr, name), value)
 
 
 @VM.instr(Operation.SYMREAD)
 def sym_read(vm, instr):
-    name = vm.registers[instr.get_8()]
-    try:
-        vm.registers[instr.get_8()] = vm.symtable[name]
-    except KeyError:
+    name = vm.registers.data[instr.get_8()]
+    value = vm.symtable.values[sym_slot(vm, instr, name)]
+    if value is UNSET:
         raise UnknownSymbol(f"{name}")
+    vm.registers.data[instr.get_8()] = value
+
+
+@VM.instr(Operation.MEMCPY)
+def mem_copy(vm, instr):
+    target, source, count = [vm.registers.data[instr.get_8()] for _ in range(3)]
+    try:
+        vm.memory.copy(target, source, count)
+    except IndexError:
+        raise MemoryFault("Copy operation on not owned area!")
+
+
+@VM.instr(Operation.MEMSET)
+def mem_set(vm, instr):
+    start, value, count = [vm.registers.data[instr.get_8()] for _ in range(3)]
+    try:
+        vm.memory.fill(start, value, count)
+    except IndexError:
+        raise MemoryFault("Set operation on not owned area!")
+
+
+@VM.instr(Operation.MEMSUM)
+def mem_sum(vm, instr):
+    start = vm.registers.data[instr.get_8()]
+    count = vm.registers.data[instr.get_8()]
+    try:
+        vm.registers.data[instr.get_8()] = vm.memory.sum(start, count)
+    except IndexError:
+        raise MemoryFault("Sum operation on not owned area!")
+
+
+@VM.instr(Operation.MEMCMP)
+def mem_compare(vm, instr):
+    first, second, count = [vm.registers.data[instr.get_8()] for _ in range(3)]
+    try:
+        vm._eqflag = vm.memory.compare(first, second, count)
+    except IndexError:
+        raise MemoryFault("Compare operation on not owned area!")
+
+
+def vector(vm, register):
+    """Returns the array in a vector register, unset ones are empty"""
+    value = vm.vectors.data[register]
+    if value is None:
+        value = vm.vectors.numpy.zeros(0, dtype=vm.vectors.numpy.int64)
+    return value
+
+
+def elementwise(func, operand1, operand2):
+    """Applies func to two vectors, lengths must match (or be 1 on a side)"""
+    try:
+        return func(operand1, operand2)
+    except ValueError:
+        raise VectorFault(f"Vector lengths {len(operand1)} and {len(operand2)} differ!")
+
+
+@VM.instr(Operation.VLOAD)
+def vector_load(vm, instr):
+    target = instr.get_8()
+    start = vm.registers.data[instr.get_8()]
+    count = vm.registers.data[instr.get_8()]
+    try:
+        cells = vm.memory.read(start, count)
+    except IndexError:
+        raise MemoryFault("Vector load from not owned area!")
+    numpy = vm.vectors.numpy
+    vm.vectors.data[target] = numpy.array(cells) if count else numpy.zeros(0, numpy.int64)
+
+
+@VM.instr(Operation.VSTORE)
+def vector_store(vm, instr):
+    value = vector(vm, instr.get_8())
+    start = vm.registers.data[instr.get_8()]
+    try:
+        vm.memory.write(start, value)
+    except IndexError:
+        raise MemoryFault("Vector store to not owned area!")
+
+
+@VM.instr(Operation.VADD)
+@VM.instr(Operation.VSUB)
+@VM.instr(Operation.VMUL)
+@VM.instr(Operation.VTRUEDIV)
+def vector_math(vm, instr):
+    operand1 = vector(vm, instr.get_8())
+    operand2 = vector(vm, instr.get_8())
+    func = getattr(operator, instr.operation.name[1:].lower())
+    vm.vectors.data[instr.get_8()] = elementwise(func, operand1, operand2)
+
+
+@VM.instr(Operation.VEQ)
+@VM.instr(Operation.VNE)
+@VM.instr(Operation.VLE)
+@VM.instr(Operation.VGE)
+@VM.instr(Operation.VGT)
+@VM.instr(Operation.VLT)
+def vector_comparison(vm, instr):
+    operand1 = vector(vm, instr.get_8())
+    operand2 = vector(vm, instr.get_8())
+    func = getattr(operator, instr.operation.name[1:].lower())
+    result = vm.vectors.data[instr.get_8()] = elementwise(func, operand1, operand2)
+    vm._eqflag = bool(result.all())
+
+
+@VM.instr(Operation.VSUM)
+@VM.instr(Operation.VMIN)
+@VM.instr(Operation.VMAX)
+def vector_reduce(vm, instr):
+    value = vector(vm, instr.get_8())
+    if not len(value) and instr.operation is not Operation.VSUM:
+        raise VectorFault(f"{instr.operation.name} of an empty vector!")
+    result = getattr(value, instr.operation.name[1:].lower())()
+    if hasattr(result, "item"):
+        result = result.item()  # NumPy scalars to Python values
+    vm.registers.data[instr.get_8()] = result
+
+
+@VM.instr(Operation.CAS)
+def compare_and_swap(vm, instr):
+    position, expected, value = [instr.get_8() for _ in range(3)]
+    registers = vm.registers.data
+    try:
+        old = vm.memory.cas(registers[position], registers[expected], registers[value])
+    except IndexError:
+        raise MemoryFault("Compare and swap on not owned area!")
+    vm._eqflag = old == registers[expected]
+    registers[expected] = old
+
+
+@VM.instr(Operation.FADD)
+def fetch_add(vm, instr):
+    position = vm.registers.data[instr.get_8()]
+    value = vm.registers.data[instr.get_8()]
+    try:
+        vm.registers.data[instr.get_8()] = vm.memory.fetch_add(position, value)
+    except IndexError:
+        raise MemoryFault("Fetch and add on not owned area!")
+
+
+@VM.instr(Operation.FENCE)
+def fence(vm, instr):
+    vm.memory.fence()
+
+
+@VM.instr(Operation.BARRIER)
+def barrier(vm, instr):
+    position, parties = [vm.registers.data[instr.get_8()] for _ in range(2)]
+    try:
+        vm.memory.barrier(position, parties)
+    except IndexError:
+        raise MemoryFault("Barrier on not owned area!")
+
+
+@VM.instr(Operation.SPAWN)
+def spawn(vm, instr):
+    counter = vm.registers.data[instr.get_8()]
+    target = instr.get_8()
+    thread = vm.spawn(counter)
+    vm.registers.data[target] = vm.threads[thread].registers[target] = thread
+    raise Switch()
+
+
+@VM.instr(Operation.JOIN)
+def join(vm, instr):
+    thread = vm.registers.data[instr.get_8()]
+    if thread not in vm.threads:
+        raise ThreadError(f"Unknown thread {thread}!")
+    if not vm.finished(thread):
+        vm.threads[vm.thread].waiting = thread
+        raise Switch()
+
+
+@VM.instr(Operation.YIELD)
+def yield_(vm, instr):
+    raise Switch()
 
 
 @VM.instr(Operation.CCALL)
 def ccall(vm, instr):
-    operation = vm.registers[instr.get_8()]
-    args = [vm.registers[value] for value in instr.operands[1:-1]]
-    args = [bytes(arg, 'utf8') for arg in args if isinstance(arg, str)] # Unicode to byte
-    vm.registers[instr.get_8()] = getattr(libc, operation)(*args)
+    operation = vm.registers.data[instr.get_8()]
+    args = [vm.registers.data[value] for value in instr.operands[1:-1]]
+    vm.registers.data[instr.get_8()] = vm.bindings.call(operation, args, vm.memory)
 
 
 @VM.instr(Operation.NOP)
@@ -1,3 +1,4 @@
+import re
 from pathlib import Path
 from setuptools import setup, find_packages
 
@@ -6,9 +7,12 @@ current_dir = Path(__file__).parent.resolve()
 with open(current_dir / 'README.md', encoding='utf-8') as f:
     long_description = f.read()
 
+with open(current_dir / 'arkhe' / '__init__.py', encoding='utf-8') as f:
+    version = re.search(r'__version__ = "(.+)"', f.read()).group(1)
+
 setup(
     name="arkhe",
-    version="0.2.6",
+    version=version,
     packages=find_packages(),
     author="BTaskaya",
     author_email="batuhanosmantaskaya@gmail.com",
@@ -1,11 +1,56 @@
+import asyncio
+import ctypes
+import ctypes.util
+import faulthandler
+import json
 import os
 import pytest
 
+from contextlib import redirect_stdout
 from io import StringIO
-from arkhe.controller import Arkhe, RegisterNotFound, Registers
+from arkhe.__main__ import main as arkhe_main
+from arkhe import binary, parallel
+from arkhe.aot import translate
+from arkhe.controller import Arkhe, RegisterNotFound, Registers, Symtable
 from arkhe.debugger import ADB
+from arkhe.ffi import MEMORY, Bindings
 from arkhe.utils import create_instr, divide_sequence
-from arkhe.vm import INSTR_TERM, Operation, TypeTable, MemoryFault
+from arkhe.lang.cache import CompileCache
+from arkhe.memory import MappedMemory, Memory, NumpyMemory, PagedMemory, SharedMemory
+from arkhe.lang.compiler import Parser, UnexpectedInput
+from arkhe.optimizer import optimize
+from arkhe.pool import MAX_CONSTANTS, ConstantPool
+from arkhe.scheduler import Scheduler, evaluate
+from arkhe.verifier import VerificationError, verify
+from arkhe.vm import (
+    HLT,
+    BudgetExceeded,
+    INSTR_TERM,
+    Instr,
+    InvalidConstant,
+    MemoryFault,
+    Operation,
+    ThreadError,
+    TypeTable,
+    UnknownSymbol,
+    VectorFault,
+)
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv("ARKHE_CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.delenv("ARKHE_NO_CACHE", raising=False)
+    return tmp_path / "cache"
+
+
+@pytest.fixture
+def deadline():
+    """Aborts the run with tracebacks if a test waiting on other processes
+    (e.g at a shared memory barrier) hangs"""
+    faulthandler.dump_traceback_later(120, exit=True)
+    yield
+    faulthandler.cancel_dump_traceback_later()
+
 
 def test_utils_divideseq():
     data = [1, 2, 3, 0, 1, 2, 0, 1, 0, 1, 2, 3, 4, 5, 0]
@@ -39,6 +84,30 @@ def test_register_set():
     assert registers[5] == 15
 
 
+def test_register_file():
+    registers = Registers(4)
+    registers["2"] = 5
+    assert registers.data == [0, 0, 5, 0]
+    assert dict(registers.items()) == {0: 0, 1: 0, 2: 5, 3: 0}
+    with pytest.raises(RegisterNotFound):
+        registers[-1]
+
+
+def test_register_checked_on_decode():
+    code = [*create_instr("load", 0, 0, 1), *create_instr("add", 0, 40, 1)]
+    vm = Arkhe(code)
+    with pytest.raises(RegisterNotFound):
+        vm.eval()
+    assert vm.registers[0] == 1 and vm.counter == 5
+
+    stream = StringIO()
+    adb = ADB(stream)
+    adb.run_cmd("r5 = 7")
+    assert adb.vm.registers[5] == 7
+    with pytest.raises(RegisterNotFound):
+        adb.run_cmd("r40 = 7")
+
+
 def test_vm_load():
     code = create_instr("load", 0, 0, 100)
     vm = Arkhe(code)
@@ -330,6 +399,52 @@ def test_ext_libc():
     vm.exc_instr()
     assert vm.registers[1] == os.getpid()
 
+
+@pytest.mark.parametrize("engine", [None, "threaded"])
+def test_ext_bindings(engine):
+    code = create_instr("ccall", 0, 1, 2, 3, 1)
+    vm = Arkhe(code, engine=engine)
+    vm.registers[0], vm.registers[1] = "abs", -5
+    vm.eval()
+    assert vm.registers[1] == 5
+
+    vm.bindings.declare("strlen", [ctypes.c_char_p], ctypes.c_size_t)
+    vm.counter, vm.registers[0], vm.registers[1] = 0, "strlen", "hello"
+    vm.eval()
+    assert vm.registers[1] == 5
+    assert vm.bindings.calls == {"abs": 1, "strlen": 1}
+
+    vm.bindings.declare("memset", [MEMORY, ctypes.c_int, ctypes.c_size_t], ctypes.c_void_p)
+    for memory in (Memory(), NumpyMemory()):
+        vm.memory = memory
+        memory.alloc(2)
+        vm.counter = 0
+        vm.registers.data[:4] = "memset", 1, 1, 8
+        vm.eval()
+        assert list(memory) == [0, 0x0101010101010101]
+
+    vm.counter, vm.registers[1] = 0, 2
+    with pytest.raises(MemoryFault):
+        vm.eval()
+    vm.counter, vm.registers[0] = 0, "no_such_function"
+    with pytest.raises(UnknownSymbol):
+        vm.eval()
+
+
+def test_ext_bindings_cache():
+    bindings = Bindings(max_size=2)
+    for name in ("abs", "labs", "getpid"):
+        bindings.resolve(name)
+    assert list(bindings._cache) == ["labs", "getpid"]
+    assert bindings.resolve("getpid") is bindings.resolve("getpid")
+
+    path = ctypes.util.find_library("m")
+    if path is None:
+        pytest.skip("libm isn't available")
+    bindings.load_library(path)
+    bindings.declare("cos", [ctypes.c_double], ctypes.c_double)
+    assert bindings.call("cos", [0.0]) == 1.0
+
 def test_debugger():
     stream = StringIO()
     adb = ADB(stream)
@@ -340,3 +455,1113 @@ def test_debugger():
     assert adb.vm.registers[2] == 0
     adb.run_cmd("eval 1")
     assert adb.vm.registers[2] == 2000
+
+def test_vm_decode_table():
+    code = [*create_instr("load", 0, 0, 3), *create_instr("nop")]
+    vm = Arkhe(code)
+    vm.eval()
+    assert sorted(vm._decoded) == [0, 5]
+    vm.code.extend(create_instr("jmpb", 0))
+    vm.exc_instr()
+    assert sorted(vm._decoded) == [0, 5, 7]
+    assert vm.counter == 7
+
+
+def test_vm_decode_unaligned_jump():
+    code = [*create_instr("jmpf", 0), *create_instr("nop", 0)]
+    vm = Arkhe(code)
+    vm.registers[0] = 1
+    vm.exc_instr()
+    assert vm.counter == 4
+    assert vm.next_instr().operands == [] and vm.counter == 6
+
+
+def test_vm_decode_reset():
+    vm = Arkhe(create_instr("load", 0, 0, 1))
+    vm.eval()
+    vm.code = create_instr("load", 0, 0, 2)
+    vm.counter = 0
+    vm.eval()
+    assert vm.registers[0] == 2
+
+
+def countdown(n):
+    """r0 counts down from n to 0, r3 accumulates r0 each iteration"""
+    return [
+        *create_instr("load", 0, n >> 8, n & 0xFF),
+        *create_instr("load", 1, 0, 1),
+        *create_instr("load", 2, 0, 0),
+        *create_instr("load", 4, 0, 20),
+        *create_instr("add", 3, 0, 3),  # 20
+        *create_instr("sub", 0, 1, 0),
+        *create_instr("gt", 0, 2),
+        *create_instr("jfn", 5),
+        *create_instr("jmpb", 4),
+        *create_instr("nop"),
+    ]
+
+
+def test_engine_threaded_parity():
+    generic, threaded = Arkhe(countdown(100)), Arkhe(countdown(100), engine="threaded")
+    generic.registers[5] = threaded.registers[5] = 3
+    generic.eval()
+    threaded.eval()
+    assert threaded.registers[3] == 5050
+    assert threaded.registers.data == generic.registers.data
+    assert threaded.counter == generic.counter
+    assert threaded._eqflag == generic._eqflag
+
+
+def test_engine_threaded_step():
+    vm = Arkhe(
+        [*create_instr("load", 0, 0, 4), *create_instr("jmpf", 0)], engine="threaded"
+    )
+    vm.exc_instr()
+    assert vm.counter == 5 and vm.registers[0] == 4
+    vm.exc_instr()
+    assert vm.counter == 12
+
+
+def test_engine_threaded_faults():
+    vm = Arkhe([*create_instr("nop"), *create_instr("hlt")], engine="threaded")
+    with pytest.raises(HLT):
+        vm.eval()
+    assert vm.counter == 4
+
+    vm = Arkhe(create_instr("read", 0, 1), engine="threaded")
+    vm.registers[0] = 16
+    with pytest.raises(MemoryFault):
+        vm.eval()
+    assert vm.counter == 4
+
+    vm = Arkhe(create_instr("symread", 0, 1), engine="threaded")
+    vm.registers[0] = "age"
+    with pytest.raises(UnknownSymbol):
+        vm.eval()
+    vm.symtable["age"] = 15
+    vm.counter = 0
+    vm.eval()
+    assert vm.registers[1] == 15
+
+
+@pytest.mark.parametrize("jump", ["jeq", "jne", "jfe", "jfn"])
+@pytest.mark.parametrize("compare", ["eq", "lt", "ge"])
+def test_engine_fused_pairs(compare, jump):
+    code = [
+        *create_instr("load", 0, 0, 5),
+        *create_instr("load", 1, 0, 6),
+        *create_instr("load", 7, 0, 3),
+        *create_instr(compare, 0, 1),
+        *create_instr(jump, 2),
+        *create_instr("load", 3, 0, 1),
+        *create_instr("load", 4, 0, 2),
+        *create_instr("add", 3, 4, 5),
+    ]
+    generic, fused = Arkhe(code, jit=False), Arkhe(code, engine="threaded")
+    for vm in (generic, fused):
+        vm.registers[2] = 27 if jump in ("jeq", "jne") else 5
+        vm.eval()
+    assert fused.registers.data == generic.registers.data
+    assert fused.counter == generic.counter == len(code)
+    assert fused._eqflag is generic._eqflag
+    assert fused.engine.fused[15] is not fused.engine.handlers[15]
+
+
+def test_engine_fused_faults():
+    code = [*create_instr("load", 1, 0, 0), *create_instr("truediv", 0, 1, 2)]
+    vm = Arkhe(code, engine="threaded")
+    with pytest.raises(ZeroDivisionError):
+        vm.eval()
+    assert vm.counter == 10 and vm.registers[1] == 0
+
+    code = [*create_instr("lt", 0, 1), *create_instr("jfn", 2)]
+    vm = Arkhe(code, engine="threaded")
+    vm.registers[0] = "a"
+    with pytest.raises(TypeError):
+        vm.eval()
+    assert vm.counter == 4
+
+    vm = Arkhe(code, engine="threaded")
+    vm.registers[2] = 8
+    vm.exc_instr()
+    assert vm.counter == 4 and vm._eqflag is False
+    vm.eval()
+    assert vm.counter == 15
+
+
+def test_engine_threaded_fallback():
+    vm = Arkhe(
+        [*create_instr("alloc", 0), *create_instr("load", 40, 0, 1)], engine="threaded"
+    )
+    vm.registers[0] = 8
+    with pytest.raises(RegisterNotFound):
+        vm.eval()
+    assert len(vm.memory) == 8 and vm.counter == 3
+
+
+def test_jit_parity():
+    traced, generic = Arkhe(countdown(500)), Arkhe(countdown(500), jit=False)
+    traced.registers[5] = generic.registers[5] = 3
+    traced.eval()
+    generic.eval()
+    assert traced.jit.compiled == 1 and traced.jit.entered == 1
+    assert generic.jit is None
+    assert traced.registers.data == generic.registers.data
+    assert (traced.counter, traced._eqflag) == (generic.counter, generic._eqflag)
+
+
+def test_jit_side_exit_fault():
+    code = [
+        *create_instr("load", 1, 0, 1),
+        *create_instr("load", 2, 0, 12),
+        *create_instr("read", 0, 3),  # 10
+        *create_instr("add", 0, 1, 0),
+        *create_instr("jmpb", 2),
+    ]
+    traced, generic = Arkhe(code), Arkhe(code, jit=False)
+    for vm in traced, generic:
+        vm.memory.alloc(200)
+        vm.memory[199] = 7
+        with pytest.raises(MemoryFault):
+            vm.eval()
+    assert traced.jit.entered == 1
+    assert traced.registers.data == generic.registers.data
+    assert traced.registers[3] == 7 and traced.counter == generic.counter == 14
+
+
+def test_jit_generic_steps(monkeypatch):
+    code = [
+        *create_instr("load", 0, 1, 0x2C),
+        *create_instr("load", 1, 0, 1),
+        *create_instr("load", 2, 0, 0),
+        *create_instr("load", 4, 0, 20),
+        *create_instr("load", 5, 0, 3),
+        *create_instr("fadd", 2, 1, 6),  # 25, runs through the VM's handler
+        *create_instr("sub", 0, 1, 0),
+        *create_instr("gt", 0, 2),
+        *create_instr("jfn", 5),
+        *create_instr("jmpb", 4),
+    ]
+    built = []
+    post_init = Instr.__post_init__
+    monkeypatch.setattr(Instr, "__post_init__", lambda instr: built.append(post_init(instr)))
+    vm = Arkhe(code)
+    vm.memory.alloc(1)
+    vm.eval()
+    assert vm.memory[0] == 300 and vm.registers[6] == 299 and vm.jit.entered == 1
+    assert len(built) == 10  # decoded once, the trace dispatches the same Instr
+
+
+def load_module(source):
+    namespace = {}
+    exec(compile(source, "<aot>", "exec"), namespace)
+    return namespace
+
+
+def test_aot_parity():
+    module = load_module(translate(countdown(300)))
+    compiled, generic = Arkhe(countdown(300)), Arkhe(countdown(300), jit=False)
+    compiled.registers[5] = generic.registers[5] = 3
+    module["run"](compiled)
+    generic.eval()
+    assert compiled.registers[3] == 45150
+    assert compiled.registers.data == generic.registers.data
+    assert (compiled.counter, compiled._eqflag) == (generic.counter, generic._eqflag)
+
+
+def test_aot_faults():
+    code = [*create_instr("nop"), *create_instr("read", 0, 1), *create_instr("hlt")]
+    module = load_module(translate(code))
+    vm = Arkhe(code)
+    with pytest.raises(MemoryFault):
+        module["run"](vm)
+    assert vm.counter == 6
+    vm.memory.alloc(1)
+    with pytest.raises(HLT):
+        module["run"](vm)
+    assert vm.counter == 8
+
+
+def test_aot_unaligned_jump():
+    code = [*create_instr("jmpf", 0), *create_instr("nop", Operation.NOP)]
+    module = load_module(translate(code))
+    vm = Arkhe(code)
+    vm.registers[0] = 1
+    module["run"](vm)
+    assert vm.counter == 6
+
+
+def test_aot_cli(tmp_path):
+    source = tmp_path / "prog.ark"
+    source.write_text("LOAD 00 00 04\nLOAD 01 01 F4\nMUL 00 01 02\n")
+    arkhe_main(["compile", str(source), "-o", str(tmp_path / "prog_ark.py")])
+    module = load_module((tmp_path / "prog_ark.py").read_text())
+    vm = Arkhe()
+    module["run"](vm)
+    assert vm.registers[2] == 2000
+
+
+def test_parallel():
+    loop = [*create_instr("load", 0, 0, 0), *create_instr("jmp", 0)]
+    program = binary.Program(
+        [*create_instr("load", 0, 0, 0, TypeTable.POOL), *create_instr("symset", 0, 1)],
+        ["key"],
+    )
+    results = parallel.run(
+        [loop, create_instr("hlt"), program], workers=2, chunksize=1, instructions=1000
+    )
+    assert [type(result.error) for result in results] == [
+        parallel.BudgetExceeded,
+        HLT,
+        type(None),
+    ]
+    assert results[2].symtable == {"key": 0} and results[2].counter == 10
+
+    code = create_instr("add", 0, 1, 2)
+    results = parallel.run([code], [[1, 2], {"1": 5}], workers=0)
+    assert [result.registers[2] for result in results] == [3, 5]
+    results = parallel.run([loop], [{}], workers=0, seconds=0.05)
+    assert isinstance(results[0].error, parallel.BudgetExceeded)
+
+
+def test_parallel_cli(tmp_path):
+    source = tmp_path / "prog.ark"
+    source.write_text("ADD 00 01 02\nHLT 00\n")
+    states = tmp_path / "states.json"
+    states.write_text('[[1, 2], {"0": "a", "1": "b"}]')
+    stream = StringIO()
+    with redirect_stdout(stream):
+        arkhe_main(["run", str(source), "--states", str(states), "-j", "1"])
+    lines = [json.loads(line) for line in stream.getvalue().splitlines()]
+    assert [line["registers"][2] for line in lines] == [3, "ab"]
+    assert lines[0]["error"] == "HLT: Program stopped!" and lines[1]["counter"] == 8
+
+
+def test_parallel_shared(deadline):
+    pytest.importorskip("fcntl")
+    source = """
+    LOAD 00 00 00
+    LOAD 01 00 01
+    LOAD 05 00 00
+    LOAD 06 00 64
+    LOAD 07 00 03
+    LOAD 09 00 14
+    FADD 00 01 02
+    SUB 06 01 06
+    GT 06 05
+    JFN 07
+    JMPB 09
+    LOAD 03 00 01
+    LOAD 04 00 02
+    BARRIER 03 04
+    READ 00 08
+    """
+    memory = SharedMemory(size=3, timeout=30)
+    try:
+        results = parallel.run(
+            [Parser(cache=False)(source)], [{}, {}], workers=2, chunksize=1, memory=memory.name
+        )
+        assert [result.error for result in results] == [None, None]
+        assert [result.registers[8] for result in results] == [200, 200]
+        assert sorted(result.registers[2] for result in results)[1] == 199
+        assert list(memory) == [200, 0, 1]
+    finally:
+        memory.close()
+        memory.unlink()
+
+
+def test_scheduler():
+    def countdown_vm(n):
+        vm = Arkhe(countdown(n))
+        vm.registers[5] = 3
+        return vm
+
+    async def main():
+        scheduler = Scheduler(quantum=10)
+        ticks = []
+        sleeper = Arkhe(create_instr("ccall", 0, 1, 2))
+        sleeper.registers.data[:2] = "usleep", 200_000
+        slow = scheduler.spawn(sleeper)
+        low = scheduler.spawn(countdown_vm(300))
+        high = scheduler.spawn(countdown_vm(300), priority=4)
+        while not high.done():
+            ticks.append(low.done())
+            await asyncio.sleep(0)
+        assert ticks and not any(ticks)  # the loop kept running, high was first
+        await scheduler.join()
+        assert len(scheduler) == 0 and slow.done()
+        assert low.result().registers[3] == high.result().registers[3] == 45150
+        assert low.done() and sleeper.registers[1] == 0
+
+        scheduler.spawn(Arkhe(create_instr("hlt")))
+        await scheduler.join()
+        vm = await evaluate(countdown_vm(5), quantum=1, offload=False)
+        assert vm.registers[3] == 15
+
+    asyncio.run(main())
+
+
+def test_binary_roundtrip():
+    code = countdown(100)
+    program = binary.loads(binary.dumps(code, consts=[-5, 2 ** 70, "age", b"\x00"]))
+    assert list(program.code) == code
+    assert program.consts == [-5, 2 ** 70, "age", b"\x00"]
+    with pytest.raises(binary.InvalidProgram):
+        binary.loads(b"ARKB" + bytes(12))
+    with pytest.raises(binary.InvalidProgram):
+        binary.dumps([0x10000])
+
+    data = binary.dumps(code, consts=["age"])
+    pool = len(data) - binary.HEADER.size - len(code) * 2
+    for size in pool - 1, binary.CONST.size - 1:  # a cut payload, a cut entry
+        header = binary.HEADER.pack(binary.MAGIC, binary.VERSION, 0, len(code), size)
+        with pytest.raises(binary.InvalidProgram, match="truncated"):
+            binary.loads(header + data[binary.HEADER.size : len(data) - pool + size])
+
+
+def test_binary_mapped(tmp_path):
+    path = tmp_path / "prog.arkc"
+    with open(path, "wb") as f:
+        binary.dump(countdown(100), f)
+
+    program = binary.load_mapped(path)
+    assert isinstance(program.code, memoryview)
+    for engine in None, "threaded":
+        vm = Arkhe(program.code, engine=engine)
+        vm.registers[5] = 3
+        vm.eval()
+        assert vm.registers[3] == 5050
+
+
+def test_compile_cache(cache_dir):
+    source = "LOAD 00 00 04\nLOAD 01 01 F4\nMUL 00 01 02"
+    code = Parser()(source)
+    assert len(list(cache_dir.glob("*.arkc"))) == 1
+
+    warm = Parser()
+    assert warm(source) == code
+    assert warm._parser is None
+
+
+def test_compile_cache_eviction(tmp_path):
+    cache = CompileCache(tmp_path)
+    for n in range(10):
+        cache.put(f"source {n}", create_instr("load", 0, 0, n))
+        os.utime(cache.path(f"source {n}"), (n, n))
+    cache.max_size = 200
+    cache.evict()
+    assert sum(path.stat().st_size for path in tmp_path.glob("*.arkc")) <= 200
+    assert cache.get("source 9") == create_instr("load", 0, 0, 9)
+    assert cache.get("source 0") is None
+
+
+def test_compile_cache_opt_out(cache_dir, monkeypatch):
+    Parser(cache=False)("NOP 00")
+    monkeypatch.setenv("ARKHE_NO_CACHE", "1")
+    assert Parser().cache is None
+    Parser()("NOP 00")
+    assert not cache_dir.exists()
+
+
+def test_parser_operand_like_op():
+    parse = Parser(cache=False)
+    assert parse("LOAD 00 AB\nADD 00 01 02") == [
+        *create_instr("load", 0, 0xAB),
+        *create_instr("add", 0, 1, 2),
+    ]
+
+
+def test_parser_stream():
+    source = StringIO("LOAD 00 00 04\n\nLOAD 01 01 F4\nMUL 00 01 02\n")
+    instrs = list(Parser(cache=False).stream(source, lines=2))
+    assert instrs == [
+        create_instr("load", 0, 0, 4),
+        create_instr("load", 1, 1, 0xF4),
+        create_instr("mul", 0, 1, 2),
+    ]
+    with pytest.raises(UnexpectedInput) as exc:
+        list(Parser(cache=False).stream(StringIO("NOP 00\n\nNOP\n"), lines=2))
+    assert exc.value.line == 3
+
+
+def test_debugger_parse_error():
+    stream = StringIO()
+    adb = ADB(stream)
+    adb.run_cmd("LOAD 00 0G")
+    adb.run_cmd("LOAD")
+    assert stream.getvalue().count("couldn't parsed") == 2
+    assert adb.vm.code == []
+
+
+@pytest.mark.parametrize("store", ["array", "list", "numpy"])
+def test_memory_stores(store):
+    if store == "numpy":
+        pytest.importorskip("numpy")
+        memory = NumpyMemory()
+    else:
+        memory = Memory(store)
+
+    memory.alloc(40)
+    for n in range(40):
+        memory[n] = n
+    memory.dealloc(10, head=True)
+    memory.dealloc(5, head=False)
+    assert len(memory) == 25 and list(memory) == list(range(10, 35))
+    assert memory[0] == 10 and memory[-1] == 34 and type(memory[0]) is int
+    memory.dealloc(20, head=True)
+    memory.alloc(3)
+    assert list(memory) == [30, 31, 32, 33, 34, 0, 0, 0]
+    with pytest.raises(IndexError):
+        memory[8]
+    with pytest.raises(MemoryFault):
+        memory.dealloc(9, head=True)
+
+
+@pytest.mark.parametrize("value", ["hello", 1.5, True, 2 ** 70])
+def test_memory_promotion(value):
+    memory = Memory()
+    memory.alloc(4)
+    memory.dealloc(1, head=True)
+    memory[1] = value
+    assert memory.store == "list"
+    assert list(memory) == [0, value, 0] and memory[1] is value
+
+
+def test_memory_paged():
+    memory = PagedMemory(page_size=4, max_pages=3)
+    memory.alloc(400_000_000)
+    assert len(memory) == 400_000_000 and memory.resident == 0
+    assert memory[399_999_999] == 0
+    memory[5] = 0
+    assert memory.resident == 0
+    memory[5] = 7
+    memory[10] = "hello"
+    assert memory.resident == 8 and memory[5] == 7 and memory[10] == "hello"
+    memory[-1] = 3
+    with pytest.raises(MemoryFault):
+        memory[20] = 1
+
+    memory.dealloc(8, head=True)
+    assert memory.resident == 8 and memory[2] == "hello"
+    memory.dealloc(len(memory) - 3, head=False)
+    assert list(memory) == [0, 0, "hello"] and memory.resident == 4
+    memory.alloc(2)
+    assert list(memory) == [0, 0, "hello", 0, 0]
+
+
+def test_memory_paged_bulk():
+    memory = PagedMemory(page_size=4, max_pages=2)
+    memory.alloc(100_000)
+    memory.copy(100, 50_000, 40_000)
+    memory.fill(0, 0, 100_000)
+    assert memory.sum(0, 100_000) == 0 and memory.compare(0, 50_000, 50_000)
+    assert list(memory.read(99_998, 2)) == [0, 0] and memory.resident == 0
+
+    memory.write(2, [1, 2, 3, 0, 0, 0, 0])  # the third page only gets zeros
+    assert memory.resident == 8 and memory.sum(0, 12) == 6
+    with pytest.raises(MemoryFault):
+        memory.fill(0, 9, 12)
+    assert list(memory.read(0, 8)) == [0, 0, 1, 2, 3, 0, 0, 0]
+    memory.fill(1, "x", 2)
+    memory.copy(3, 1, 4)
+    assert memory.read(0, 8) == [0, "x", "x", "x", "x", 2, 3, 0]
+    assert memory.compare(1, 2, 2) and not memory.compare(0, 4, 2)
+    memory.fill(0, 0, 8)
+    assert memory.sum(0, 8) == 0 and memory.resident == 8
+
+
+def test_vm_paged_memory():
+    code = [*create_instr("alloc", 0), *create_instr("insert", 1, 2), *create_instr("read", 1, 3)]
+    vm = Arkhe(code, memory=PagedMemory())
+    vm.registers[0] = 50_000_000
+    vm.registers[1] = 49_999_999
+    vm.registers[2] = 42
+    vm.eval()
+    assert vm.registers[3] == 42 and vm.memory.resident == 4096
+
+    stream = StringIO()
+    adb = ADB(stream)
+    adb.vm = vm
+    adb.run_cmd("mem")
+    assert "50000000" in stream.getvalue() and "4096" in stream.getvalue()
+
+
+def test_memory_mapped(tmp_path):
+    path = tmp_path / "heap"
+    with MappedMemory(path) as memory:
+        memory.alloc(8)
+        memory[7] = 2 ** 40
+        memory[0] = -1
+        with pytest.raises(IndexError):
+            memory[8] = 1
+        with pytest.raises(MemoryFault):
+            memory[1] = "hello"
+    assert path.stat().st_size == 64
+
+    with MappedMemory(path) as memory:
+        vm = Arkhe(create_instr("read", 0, 1), memory=memory)
+        vm.registers[0] = 7
+        vm.eval()
+        assert vm.registers[1] == 2 ** 40
+        vm.counter = 0
+        vm.registers[0] = 8
+        with pytest.raises(MemoryFault):
+            vm.eval()
+
+        memory.dealloc(6, head=True)
+        assert list(memory) == [0, 2 ** 40]
+        memory.dealloc(2, head=False)
+        assert len(memory) == 0
+    assert path.stat().st_size == 0
+
+
+@pytest.mark.parametrize("backend", ["array", "list", "numpy", "paged", "mapped"])
+def test_memory_bulk(backend, tmp_path):
+    if backend == "numpy":
+        pytest.importorskip("numpy")
+        memory = NumpyMemory()
+    elif backend == "paged":
+        memory = PagedMemory(page_size=4)
+    elif backend == "mapped":
+        memory = MappedMemory(tmp_path / "heap")
+    else:
+        memory = Memory(backend)
+
+    memory.alloc(12)
+    memory.dealloc(2, head=True)
+    for n in range(10):
+        memory[n] = n
+    memory.copy(2, 0, 5)
+    assert list(memory) == [0, 1, 0, 1, 2, 3, 4, 7, 8, 9]
+    memory.copy(0, 2, 5)
+    memory.fill(5, 2 ** 62, 2)
+    assert list(memory) == [0, 1, 2, 3, 4, 2 ** 62, 2 ** 62, 7, 8, 9]
+    assert memory.sum(4, 4) == 2 ** 63 + 11
+    assert memory.compare(5, 6, 1) and not memory.compare(0, 1, 2)
+    assert memory.compare(0, 1, 0) and memory.sum(10, 0) == 0
+    for args in [(8, 0, 3), (0, -1, 2), (0, 8, 3)]:
+        with pytest.raises(IndexError):
+            memory.copy(*args)
+    assert list(memory)[8:] == [8, 9]
+    memory.write(8, [5, 6])
+    assert list(memory.read(7, 3)) == [7, 5, 6]
+
+
+def test_vm_mem_bulk():
+    source = """
+    LOAD 00 00 10
+    ALLOC 00
+    LOAD 01 00 00
+    LOAD 02 00 03
+    LOAD 03 00 04
+    MEMSET 01 02 03
+    LOAD 04 00 08
+    MEMCPY 04 01 03
+    MEMSUM 01 00 05
+    MEMCMP 01 04 03
+    """
+    code = Parser(cache=False)(source)
+    for engine in (None, "threaded"):
+        vm = Arkhe(code, engine=engine)
+        vm.eval()
+        assert list(vm.memory)[:12] == [3, 3, 3, 3, 0, 0, 0, 0, 3, 3, 3, 3]
+        assert vm.registers[5] == 24 and vm._eqflag is True
+
+    for operation in ("memcpy", "memset", "memsum", "memcmp"):
+        vm = Arkhe(create_instr(operation, 0, 1, 2))
+        vm.memory.alloc(4)
+        vm.registers.data[:3] = 2, 3, 3
+        with pytest.raises(MemoryFault):
+            vm.eval()
+        assert list(vm.memory) == [0] * 4
+
+
+def test_memory_shared(deadline):
+    pytest.importorskip("fcntl")
+    memory = SharedMemory(size=6, timeout=0.05)
+    other = SharedMemory(memory.name, timeout=0.05)
+    try:
+        assert len(other) == 6 and other.name == memory.name
+        memory.write(0, [1, 2, 3])
+        assert list(other) == [1, 2, 3, 0, 0, 0] and other.sum(0, 3) == 6
+        assert other.cas(0, 1, 7) == 1 and other.cas(0, 1, 8) == 7
+        assert memory.fetch_add(1, 5) == 2 and other[1] == 7 and memory[0] == 7
+        memory.fence()
+        memory.barrier(4, 1)
+        assert list(other)[4:] == [0, 1]
+        with pytest.raises(MemoryFault):
+            other.barrier(4, 2)
+        assert list(memory)[4:] == [0, 1]  # the timed out arrival was withdrawn
+        for method, args in [("alloc", (1,)), ("dealloc", (1, True))]:
+            with pytest.raises(MemoryFault):
+                getattr(memory, method)(*args)
+        with pytest.raises(IndexError):
+            memory.cas(6, 0, 1)
+        other.close()
+        other.close()
+        assert memory.fetch_add(2, 1) == 3  # the locks survive the other handle
+    finally:
+        other.close()
+        memory.close()
+        memory.unlink()
+
+
+@pytest.mark.parametrize("engine", [None, "threaded"])
+def test_vm_atomics(engine):
+    source = """
+    LOAD 00 00 01
+    LOAD 01 00 00
+    LOAD 02 00 05
+    LOAD 07 00 03
+    CAS 00 01 02
+    JFE 07
+    HLT 00
+    CAS 00 01 02
+    LOAD 03 00 02
+    FADD 00 03 04
+    FENCE 00
+    LOAD 05 00 02
+    LOAD 06 00 01
+    BARRIER 05 06
+    """
+    vm = Arkhe(Parser(cache=False)(source), engine=engine)
+    vm.memory.alloc(4)
+    vm.eval()
+    assert list(vm.memory) == [0, 7, 0, 1] and vm._eqflag is False
+    assert vm.registers[1] == 5 and vm.registers[4] == 5
+
+    for operation, operands in [("cas", (0, 1, 2)), ("fadd", (0, 1, 2)), ("barrier", (0, 1))]:
+        vm = Arkhe(create_instr(operation, *operands))
+        vm.memory.alloc(2)
+        vm.registers.data[:3] = 2, 2, 2
+        with pytest.raises(MemoryFault):
+            vm.eval()
+    vm = Arkhe(create_instr("barrier", 0, 1))
+    vm.memory.alloc(2)
+    vm.registers.data[:2] = 0, 2
+    with pytest.raises(MemoryFault):
+        vm.eval()
+
+
+@pytest.mark.parametrize("options", [{}, {"jit": False}, {"engine": "threaded"}])
+def test_vm_budget(options):
+    vm = Arkhe(countdown(2000), **options)
+    vm.registers[5] = 3
+    with pytest.raises(BudgetExceeded):
+        vm.eval(instructions=1000)
+    assert 1750 <= vm.registers[0] <= 1799 and vm.budget is None
+    resumed = 0
+    while True:
+        try:
+            vm.eval(instructions=1000)
+            break
+        except BudgetExceeded:
+            resumed += 1
+    assert resumed >= 5 and vm.registers[3] == 2001000 and vm.counter == len(vm.code)
+
+    vm = Arkhe([*create_instr("load", 0, 0, 0), *create_instr("jmp", 0)], **options)
+    with pytest.raises(BudgetExceeded):
+        vm.eval(seconds=0.05)
+    assert vm.counter in (0, 5)  # the threaded engine stops between any handlers
+
+    threads = assemble_threads(
+        "LOAD 0A 00 01\nLOAD 0B 00 {6}\nLOAD 08 00 64\nLOAD 01 00 {6}\nSPAWN 01 05\n"
+        "JOIN 05\nADD 09 0A 09\nSUB 08 0A 08\nGT 08 02\nJEQ 0B"
+    )
+    vm = Arkhe(threads, **options)
+    vm.switch_every = 7
+    with pytest.raises(BudgetExceeded):
+        vm.eval(instructions=100)
+    while True:
+        try:
+            vm.eval(instructions=100)
+            break
+        except BudgetExceeded:
+            pass
+    assert vm.registers[9] == 100 and vm.registers[8] == 0 and vm.threads == {}
+
+
+def assemble_threads(source):
+    """Assembles source, filling {n} with the offset of its nth instruction
+    (counting from 0, one past the last is the end of the code)"""
+    parser = Parser(cache=False)
+    code = parser(source.format(*["00"] * 32))
+    offsets = [offset for offset, _, _ in Arkhe(code).instructions()] + [len(code)]
+    return parser(source.format(*[f"{offset:02X}" for offset in offsets]))
+
+
+@pytest.mark.parametrize("options", [{}, {"jit": False}, {"engine": "threaded"}])
+def test_vm_threads(options):
+    # the main thread spins until the worker counts down and sets cell 0
+    source = """
+    LOAD 00 00 01
+    ALLOC 00
+    LOAD 02 00 00
+    LOAD 0A 00 01
+    LOAD 08 00 32
+    LOAD 0B 00 {17}
+    LOAD 01 00 {17}
+    SPAWN 01 05
+    LOAD 06 00 {10}
+    LOAD 07 00 {22}
+    READ 02 03
+    {spin}
+    ADD 09 0A 09
+    EQ 03 02
+    JEQ 06
+    JOIN 05
+    JMP 07
+    SUB 08 0A 08
+    GT 08 02
+    JEQ 0B
+    LOAD 03 00 01
+    INSERT 02 03
+    """
+    # preempted every 7 instructions, or switching only when main YIELDs
+    for spin, switch_every, spins in [("NOP 00", 7, 10), ("YIELD 00", 10 ** 9, 1)]:
+        code = assemble_threads(source.replace("{spin}", spin))
+        vm = Arkhe(code, **options)
+        vm.switch_every = switch_every
+        vm.eval()
+        assert list(vm.memory) == [1] and vm.threads == {} and vm.counter == len(code)
+        assert vm.registers[3] == vm.registers[5] == 1 and vm.registers[8] == 50
+        assert vm.registers[9] >= spins
+
+    deadlock = assemble_threads("LOAD 01 00 {4}\nLOAD 0C 00 00\nSPAWN 01 05\nJOIN 05\nJOIN 0C")
+    vm = Arkhe(deadlock, **options)
+    with pytest.raises(ThreadError):
+        vm.eval()
+    assert set(vm.threads) == {0, 1}
+    vm = Arkhe(create_instr("join", 0), **options)
+    vm.registers[0] = 3
+    with pytest.raises(ThreadError):
+        vm.eval()
+
+
+@pytest.mark.parametrize("engine", [None, "threaded"])
+def test_vm_vectors(engine):
+    pytest.importorskip("numpy")
+    source = """
+    LOAD 01 00 00
+    LOAD 02 00 04
+    VLOAD 00 01 02
+    VLOAD 01 02 02
+    VADD 00 01 02
+    VSTORE 02 02
+    VTRUEDIV 02 01 03
+    VGE 02 00 04
+    VSUM 02 03
+    VMAX 03 04
+    """
+    vm = Arkhe(Parser(cache=False)(source), engine=engine)
+    vm.memory.alloc(8)
+    vm.memory.write(0, range(8))
+    vm.eval()
+    assert list(vm.memory) == [0, 1, 2, 3, 4, 6, 8, 10]
+    assert vm.registers[3] == 28 and type(vm.registers[3]) is int
+    assert vm.registers[4] == 10 / 7 and vm._eqflag is True
+    assert vm.vectors[4].tolist() == [True] * 4
+
+    stream = StringIO()
+    adb = ADB(stream)
+    adb.vm = vm
+    adb.run_cmd("vregs")
+    adb.run_cmd("v2")
+    assert "Useds: 5" in stream.getvalue() and "v2 = [ 4  6  8 10]" in stream.getvalue()
+
+    vm.counter, vm.registers[1] = 10, 6
+    with pytest.raises(MemoryFault):
+        vm.eval()
+    assert vm.vectors[0].tolist() == [0, 1, 2, 3]
+    for code in create_instr("vmin", 5, 0), create_instr("vadd", 0, 5, 6):
+        vm.counter, vm.code = 0, code
+        with pytest.raises(VectorFault):
+            vm.eval()
+    vm.vectors[6] = vm.vectors[0][:1]
+    vm.counter, vm.code = 0, create_instr("vmul", 0, 6, 7)
+    vm.eval()
+    assert vm.vectors[7].tolist() == [0, 0, 0, 0]
+    with pytest.raises(RegisterNotFound):
+        Arkhe(create_instr("vadd", 0, 1, 8)).eval()
+    with pytest.raises(VerificationError):
+        verify(create_instr("vsum", 8, 0))
+
+
+def test_batch():
+    pytest.importorskip("numpy")
+    from arkhe.batch import Batch
+
+    source = """
+    LOAD 01 00 01
+    LOAD 02 00 00
+    LOAD 04 00 14
+    LOAD 05 00 03
+    ALLOC 01
+    ADD 03 00 03
+    SUB 00 01 00
+    GT 00 02
+    JFN 05
+    JMPB 04
+    INSERT 02 03
+    READ 02 07
+    MUL 07 07 08
+    MUL 08 08 08
+    MUL 08 08 08
+    TRUEDIV 03 00 09
+    SYMSET 07 03
+    """
+    code = Parser(cache=False)(source)
+    inputs = [0, 1, 5, 2.5, "x", 1000]
+    batch = Batch(code, {0: inputs})
+    batch.eval()
+    for lane, value in enumerate(inputs):
+        vm = Arkhe(code)
+        vm.registers[0] = value
+        try:
+            vm.eval()
+        except Exception as exc:
+            assert type(batch.errors.pop(lane)) is type(exc)
+        registers = batch.lane(lane)
+        assert registers == vm.registers.data
+        assert list(map(type, registers)) == list(map(type, vm.registers.data))
+        assert batch.memory(lane) == list(vm.memory)
+        assert batch.counters[lane] == vm.counter
+    assert not batch.errors
+    assert batch.registers[8].dtype == object and batch.lane(5)[8] == 500500 ** 8
+
+
+def test_verifier():
+    decoded = verify(countdown(10))
+    assert sorted(decoded)[:3] == [0, 5, 10]
+    assert verify([]) == {}
+
+
+@pytest.mark.parametrize(
+    "code, offset",
+    [
+        ([*create_instr("nop"), 0x999, INSTR_TERM], 2),
+        ([*create_instr("nop"), Operation.ADD, 0, 1], 2),
+        (create_instr("add", 0, 1), 0),
+        (create_instr("jmp", 0, 1), 0),
+        (create_instr("read", 0, 32), 0),
+        (create_instr("ccall", 40, 1), 0),
+        (create_instr("load", 0, 1), 0),
+        (create_instr("load", 0, 65, 0xFD7), 0),
+        (create_instr("dealloc", 2, 0), 0),
+    ],
+)
+def test_verifier_errors(code, offset):
+    with pytest.raises(VerificationError) as exc:
+        verify(code)
+    assert exc.value.offset == offset
+
+
+def test_vm_verify():
+    vm = Arkhe(countdown(10), verify=True)
+    assert vm._decoded_upto == len(vm.code)
+    vm.registers[5] = 3
+    vm.eval()
+    assert vm.registers[3] == 55
+    with pytest.raises(VerificationError):
+        Arkhe(create_instr("load", 0, 1), verify=True)
+    assert verify(create_instr("load", 0, 104, 105, TypeTable.STR))
+    assert verify(create_instr("dealloc", 1, 0))
+
+
+def test_optimizer_folds():
+    code = [
+        *create_instr("nop"),
+        *create_instr("load", 0, 0, 1),
+        *create_instr("load", 0, 0, 1),
+        *create_instr("load", 1, 0, 2),
+        *create_instr("add", 0, 1, 0),
+        *create_instr("load", 6, 0, 2),
+        *create_instr("jmpf", 6),
+        *create_instr("nop"),
+        *create_instr("load", 7, 0, 9),
+    ]
+    optimized = optimize(code)
+    assert optimized.saved == 14
+    assert optimized.code == [
+        *create_instr("load", 1, 0, 2),
+        *create_instr("load", 0, 0, 3),
+        *create_instr("load", 6, 0, 0),
+        *create_instr("jmpf", 6),
+        *create_instr("load", 7, 0, 9),
+    ]
+
+    vm = Arkhe(optimized.code)
+    vm.eval()
+    assert vm.registers.data[:2] == [3, 2] and vm.registers[7] == 9
+
+
+def test_optimizer_relocates_loops():
+    code = [
+        *create_instr("load", 0, 0, 100),
+        *create_instr("load", 1, 0, 1),
+        *create_instr("load", 2, 0, 0),
+        *create_instr("load", 4, 0, 29),
+        *create_instr("load", 5, 0, 5),
+        *create_instr("add", 3, 0, 3),  # 25
+        *create_instr("nop"),
+        *create_instr("load", 1, 0, 1),
+        *create_instr("sub", 0, 1, 0),
+        *create_instr("gt", 0, 2),
+        *create_instr("jfn", 5),
+        *create_instr("nop"),
+        *create_instr("jmpb", 4),
+        *create_instr("nop"),
+    ]
+    optimized = optimize(code)
+    assert optimized.saved == 6
+    vm = Arkhe(optimized.code)
+    vm.eval()
+    assert vm.registers[3] == 5050
+    assert vm.registers[4] == 25 and vm.registers[5] == 3
+
+
+def test_optimizer_jump_chains():
+    code = [
+        *create_instr("load", 0, 0, 15),
+        *create_instr("load", 1, 0, 22),
+        *create_instr("jmp", 0),
+        *create_instr("nop"),
+        *create_instr("nop"),
+        *create_instr("jmp", 1),  # 17
+        *create_instr("nop"),
+        *create_instr("load", 2, 0, 7),  # 22
+    ]
+    optimized = optimize(code)
+    assert optimized.code[:10] == [
+        *create_instr("load", 0, 0, 16),
+        *create_instr("load", 1, 0, 16),
+    ]
+    vm = Arkhe(optimized.code)
+    vm.eval()
+    assert vm.registers[2] == 7
+
+
+def test_optimizer_refuses():
+    code = countdown(10)  # r5 is set from outside
+    assert optimize(code).code == code and optimize(code).saved == 0
+
+    # r0 is both a jump distance and an operand, the skipped NOPs must stay
+    code = [
+        *create_instr("load", 0, 0, 4),
+        *create_instr("jmpf", 0),
+        *create_instr("nop"),
+        *create_instr("nop"),
+        *create_instr("add", 0, 0, 1),
+        *create_instr("nop"),
+    ]
+    assert optimize(code).code == code[:-2]
+    assert optimize([*create_instr("nop"), Operation.ADD]).saved == 0
+
+
+def test_optimizer_parser(tmp_path):
+    parser = Parser(optimize=True)
+    assert parser("NOP 00\nLOAD 00 00 04\nNOP 00\n") == create_instr("load", 0, 0, 4)
+    assert parser.saved == 6
+
+    source = tmp_path / "prog.ark"
+    source.write_text("NOP 00\nLOAD 00 00 04\n")
+    stream = StringIO()
+    with redirect_stdout(stream):
+        arkhe_main(["compile", "-O", str(source), "-o", str(tmp_path / "prog_ark.py")])
+    assert "saved 3 code words" in stream.getvalue()
+
+
+def test_pool_constants():
+    pool = ConstantPool([2 ** 70, "age"])
+    code = [
+        *pool.load(0, 2 ** 70),
+        *pool.load(1, b"\x00\xff"),
+        *create_instr("load", 2, 97, 103, 101, TypeTable.STR),
+        *create_instr("load", 3, 0, 1, TypeTable.POOL),
+    ]
+    assert len(pool) == 3
+    for engine in (None, "threaded"):
+        vm = Arkhe(code, engine=engine, consts=pool)
+        vm.eval()
+        assert vm.registers.data[:2] == [2 ** 70, b"\x00\xff"]
+        assert vm.registers[2] is vm.registers[3] is pool[1]
+    assert len(pool) == 3
+
+    vm = Arkhe(create_instr("load", 0, 0, 7, TypeTable.POOL))
+    with pytest.raises(InvalidConstant):
+        vm.eval()
+    with pytest.raises(VerificationError):
+        vm.verify()
+
+
+def test_pool_decoded_once():
+    code = create_instr("load", 0, 104, 105, TypeTable.STR)
+    vm = Arkhe(code, jit=False)
+    vm.eval()
+    instr, _ = vm._decoded[0]
+    assert instr.const == "hi" and vm.consts.values == []
+    vm.counter = 0
+    vm.eval()
+    assert vm.registers[0] is instr.const is vm.consts.intern("hi")
+
+    pool = ConstantPool(["a"])
+    assert pool.intern("".join("a")) is pool[0]
+    for n in range(MAX_CONSTANTS + 1):
+        pool.intern(str(n))
+    assert len(pool) == 1 and pool.intern(str(n)) is pool.intern(str(n))
+
+
+def test_pool_binary(tmp_path):
+    pool = ConstantPool()
+    code = [*pool.load(0, -(2 ** 40)), *pool.load(1, "name"), *create_instr("symset", 1, 0)]
+    (tmp_path / "prog.arkc").write_bytes(binary.dumps(code, pool))
+    program = binary.load_mapped(tmp_path / "prog.arkc")
+    vm = Arkhe(program.code, consts=program.consts, verify=True)
+    vm.eval()
+    assert vm.symtable["name"] == -(2 ** 40)
+
+
+def test_symtable_mapping():
+    symtable = Symtable(b=1)
+    symtable["a"] = 2
+    symtable["b"] = 3
+    assert list(symtable.items()) == [("b", 3), ("a", 2)]
+    del symtable["b"]
+    symtable["b"] = 4
+    assert list(symtable) == ["a", "b"] and len(symtable) == 2
+    assert repr(symtable) == "{'a': 2, 'b': 4}"
+    with pytest.raises(KeyError):
+        symtable["c"]
+    symtable.slot("c")
+    assert "c" not in symtable and symtable.get("c") is None
+
+
+@pytest.mark.parametrize("engine", [None, "threaded"])
+def test_symtable_inline_cache(engine):
+    code = [
+        *create_instr("load", 0, 110, 97, 109, 101, TypeTable.STR),
+        *create_instr("symset", 0, 1),
+        *create_instr("symread", 0, 2),
+        *create_instr("symread", 3, 4),
+    ]
+    vm = Arkhe(code, engine=engine)
+    vm.registers[1] = 7
+    vm.registers[3] = "name"
+    vm.eval()
+    assert vm.registers[2] == vm.registers[4] == 7
+
+    vm.counter, vm.registers[0], vm.registers[1] = 8, 5, 8
+    vm.symtable = Symtable(name=1)
+    vm.eval()
+    assert vm.symtable == {"name": 1, 5: 8}
+    assert vm.registers[2] == 8 and vm.registers[4] == 1
+
+    vm.counter, vm.registers[3] = 16, "missing"
+    with pytest.raises(UnknownSymbol):
+        vm.eval()
+
+    stream = StringIO()
+    adb = ADB(stream)
+    adb.vm.symtable = vm.symtable
+    adb.run_cmd("symtable")
+    assert "name" in stream.getvalue() and "8" in stream.getvalue()